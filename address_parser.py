@@ -11,10 +11,43 @@
 ###################################################################################
 ## Library Import
 ###################################################################################
-import sys,os,re,string
-import arcpy,csv,xlrd,pyodbc
+import sys,os,re,string,time
+import arcpy,csv,xlrd,pyodbc,multiprocessing,sqlite3,mmap,hashlib,json,math,pickle,cProfile
+from bisect import bisect_right
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from datetime import datetime
+from itertools import islice
 from address import AddressParser, Address
+try:
+    import pandas                                                                       ## Optional, used by the columnar formatting mode.
+except ImportError:
+    pandas = None
+try:
+    import resource                                                                     ## Used to report peak memory. Not available on Windows.
+except ImportError:
+    resource = None
+try:
+    import openpyxl                                                                     ## Optional, used to stream XLSX files.
+except ImportError:
+    openpyxl = None
+try:
+    import shapely                                                                      ## Optional, lets the local spatial join test whole batches of points at once.
+    if not hasattr(shapely, 'STRtree'):                                                 ## Only shapely 2 has the vectorized functions.
+        shapely = None
+except ImportError:
+    shapely = None
+try:
+    import shapefile                                                                    ## Optional, pyshp is used to read shapefile polygons for the local spatial join.
+except ImportError:
+    shapefile = None
+try:
+    import pyarrow                                                                      ## Optional, lets pandas run the columnar string operations natively.
+    import pyarrow.parquet                                                              ## Also used by the Parquet output writer.
+    columnStringType = 'string[pyarrow]'
+except ImportError:
+    pyarrow = None
+    columnStringType = object
 arcpy.env.overwriteOutput = True
 
 ###################################################################################
@@ -31,6 +64,7 @@ inZipCodeColumn = None
 
 ## Outputs which are required.
 outGeodatabase = None
+outFormat = "Geodatabase"                                                               ## Can be Geodatabase, SQLite, CSV or Parquet. Other formats are written to the outGeodatabase folder.
 
 ## Outputs which are optional.
 outCorrections = None                                                                   ## Output corrections to a table.
@@ -59,304 +93,1587 @@ arcpy.env.workspace = outGeodatabase
 ###################################################################################
 approvedJoinList = ["2010 Census Block","2010 Census Block Group"]
 approvedParseList = ["HOUSE_NBR","STREET_PRE","STREET_NAME","STREET_SUF","STREET_APT"]
+approvedOutputList = ["Geodatabase","SQLite","CSV","Parquet"]
 columnList = ["UNIQUE_ROW","ADDRESS","ZIP_CODE"]
-errorRowList = []                                                                       ## Holds row numbers which have an error detected in them.
-formatAddressList = []
-formatZipList = []                                                                      ## Name of files automatically created under the Geodatabase.
-outTable = "Address_List"
+columnTypeList = {"X": "DOUBLE", "Y": "DOUBLE"}                                         ## Output columns which aren't text.
+joinColumnList = ["UNIQUE_ROW","X","Y","GEOID"]                                         ## Columns written by the local spatial join.
+geocodeColumnList = ["UNIQUE_ROW","ADDRESS","ZIP_CODE","X","Y","STATUS"]                ## Columns written by the local geocoder. STATUS is M for matched and U for unmatched.
+csvEncoding = "utf-8-sig"                                                               ## Encoding of CSV input files.
+unitDesignatorList = ["REAR","UPPER","UPPR","LOWER","LOWR","BACK"]                      ## Unit designators removed from addresses. Add new designators here.
+errorColumnList = ["ERROR_REASON"]                                                      ## Extra column added to the correction table.
+errorReasonList = ["BLANK_ADDRESS","FIRE_NUMBER","BLANK_ZIP","NON_NUMERIC_ZIP","PARSE_FAILED"] ## Reason codes recorded for rows sent to the correction table.
+chunkSize = 1000                                                                        ## Number of rows handed to the parser at a time.
+rowCacheDatabase = None                                                                 ## Path to a SQLite file which keeps formatted and parsed rows between runs. None turns it off.
+rowCacheSize = 5000000                                                                  ## Maximum number of rows kept in the row cache database.
+incrementalMode = False                                                                 ## Only format, parse, geocode and join rows inserted or changed since the last run.
+inKeyColumn = None                                                                      ## Optional column which identifies an input row between runs. The row position is used when None.
+rowStateDatabase = None                                                                 ## Path to a SQLite file which keeps a content hash of every input row for incremental runs.
+localGeocode = False                                                                    ## Geocode against geocodeReferenceFile in this script instead of with the address locator.
+geocodeReferenceFile = None                                                             ## GeoJSON file or shapefile of street centerlines with address ranges, or of address points.
+geocodeFieldList = {"FROM": "FROM_ADDR", "TO": "TO_ADDR", "NAME": "STREET_NAME", "SUFFIX": "STREET_SUF", "ZIP": "ZIP_CODE"} ## Reference attributes. Address points only need FROM.
+geocodeCacheSize = 100000                                                               ## Maximum number of geocoded addresses kept in memory.
+localJoin = False                                                                       ## Join geocoded addresses to blocks in this script instead of with arcpy.SpatialJoin_analysis.
+joinPolygonFiles = {"2010 Census Block": r"C:\GIS\485\Final Project\BackgroundData\Rock_County_2010_Census_Block.geojson",
+    "2010 Census Block Group": r"C:\GIS\485\Final Project\BackgroundData\Rock_County_2010_Census_Block_Group.geojson"} ## GeoJSON or shapefile polygons for the local spatial join, in the locator's coordinate system.
+joinIdField = "GEOID10"                                                                 ## Polygon attribute written to the GEOID column.
+joinIndexFolder = None                                                                  ## Folder where polygon indexes are saved between runs. None rebuilds the index every run.
+joinBatchSize = 100000                                                                  ## Number of points assigned to polygons at a time.
+reportFile = None                                                                       ## Path of a JSON run report with per stage timings, cache hit rates, error counts and peak memory.
+progressInterval = 0                                                                    ## Seconds between progress messages while rows are processed. 0 turns them off.
+profileFile = None                                                                      ## Path where a cProfile of the timed stages is saved. None turns profiling off.
+rulesVersion = 1                                                                        ## Increase when the formatting or parsing rules change so cached rows are rebuilt.
+parseCacheSize = 100000                                                                 ## Maximum number of parsed addresses kept in memory.
+columnarMode = False                                                                    ## Format rows as pandas columns when pandas is installed.
+columnarBatchSize = 20000                                                               ## Rows formatted together in columnarMode. Below about 3,000 rows pandas is slower than formatting row by row.
+writeBatchSize = 10000                                                                  ## Number of rows buffered by an output writer before they are written.
+workerCount = 1                                                                         ## Number of processes used to format and parse rows. 0 uses every core.
+workerSettingList = ["columnarMode","unitDesignatorList","parseCacheSize"]              ## Script controls copied into each worker process. Workers started with spawn import the script again.
+outTable = "Address_List"                                                               ## Name of files automatically created under the Geodatabase.
 outCorrectionTable = "Address_Errors"
-outGeocode = "Geocoded_Addresses"
+outGeocodeTable = "Geocoded_Addresses"
 outJoinDataset = "Joined_Addresses"
-tablePath = "{0}\{1}".format(outGeodatabase, outTable)
-correctionTablePath = "{0}\{1}".format(outGeodatabase, outCorrectionTable)
+outDeltaTable = "Address_Delta"                                                         ## Rows inserted or changed by an incremental run, geocoded and joined on their own.
+outGeocodeDeltaTable = "Geocoded_Delta"
+outJoinDeltaTable = "Joined_Delta"
+outSQLiteDatabase = "Address_Output.sqlite"                                             ## Name of the database created under the output folder for SQLite output.
 
 def main():
 ####################################################################################
 ## Calls each part of the script.
 ####################################################################################
-userInput()
-arcpy.AddMessage(selType)
-checkFileType(inDatabase, selType, inTable, inAddressColumn, inZipCodeColumn)
+    userInput()
+    arcpy.AddMessage(selType)
+    runStats.start()
+    try:
+        runPipeline()
+    finally:
+        runStats.finish()
 
-if outGeocode is True:
-    geocodeAddress(inTable, inAddressLocator, outGeocode)
+def runPipeline():
+####################################################################################
+## Reads, formats and writes the address table, then geocodes and joins it if requested.
+####################################################################################
+    usesArcpyTables = outGeocode == True and (not localGeocode or (selJoinDatasetType is not None and not localJoin))
+    if usesArcpyTables and outFormat != "Geodatabase":                                  ## The address locator and arcpy join read and write geodatabase tables.
+        arcpy.AddError("Error, geocoding with the address locator or the arcpy spatial join needs Geodatabase output. Use localGeocode and localJoin with {0} output.".format(outFormat))
+        raise ValueError(outFormat)
+    if outGeocode == True and localGeocode and selJoinDatasetType is not None and not localJoin: ## The local geocoder writes X and Y columns, not point features.
+        arcpy.AddError("Error, the arcpy spatial join needs point features from the address locator. Use localJoin with localGeocode.")
+        raise ValueError(selJoinDatasetType)
+    deltaKeys = checkFileType(inDatabase, selType, inTable, inAddressColumn, inZipCodeColumn)
 
-if outGeocode is True and outJoinDatasetLocation is not None and selJoinDatasetType is not None:
-    spatialJoin(outGeocode, outJoinDatasetLocation)
+    if outGeocode == True:
+        if localGeocode:
+            if deltaKeys is None or deltaKeys:
+                localGeocodeTable(deltaKeys)
+        elif deltaKeys is None:
+            geocodeAddress(geodatabasePath(outTable), inAddressLocator, geodatabasePath(outGeocodeTable))
+        elif deltaKeys:                                                                 ## Incremental runs only geocode the rows which changed.
+            geocodeAddress(geodatabasePath(outDeltaTable), inAddressLocator, geodatabasePath(outGeocodeDeltaTable))
+            mergeDelta(outGeocodeTable, outGeocodeDeltaTable, deltaKeys)
+
+    if outGeocode == True and selJoinDatasetType is not None:
+        if localJoin:
+            geocodedTable = outGeocodeTable if deltaKeys is None else outGeocodeDeltaTable
+            if localGeocode and (deltaKeys is None or deltaKeys):
+                localSpatialJoin(selJoinDatasetType, readTablePoints(geocodedTable), deltaKeys)
+            elif deltaKeys is None or deltaKeys:
+                localSpatialJoin(selJoinDatasetType, readGeocodedPoints(geodatabasePath(geocodedTable)), deltaKeys)
+        elif deltaKeys is None:
+            spatialJoin(selJoinDatasetType, geodatabasePath(outGeocodeTable), geodatabasePath(outJoinDataset))
+        elif deltaKeys:
+            spatialJoin(selJoinDatasetType, geodatabasePath(outGeocodeDeltaTable), geodatabasePath(outJoinDeltaTable))
+            mergeDelta(outJoinDataset, outJoinDeltaTable, deltaKeys)
+
+def geodatabasePath(tableName):
+####################################################################################
+## Returns the full path of an output table. arcpy resolves bare table names against arcpy.env.workspace,
+## which checkFileType points at the input geodatabase.
+####################################################################################
+    return "{0}\\{1}".format(outGeodatabase, tableName)
 
 def userInput():
 ####################################################################################
 ## Obtains user input from arcpy
 ####################################################################################
-inDatabase = arcpy.GetParameterAsText(0)                                                ## Inputs which are required.
-selType = arcpy.GetParameterAsText(1)
-inAddressLocator = arcpy.GetParameterAsText(2)
-inTable = arcpy.GetParameterAsText(3)
-inAddressColumn = arcpy.GetParameterAsText(4)
-inZipCodeColumn = arcpy.GetParameterAsText(5)
-outGeodatabase = arcpy.GetParameterAsText(6)                                            ## Outputs which are required.
-outCorrections = arcpy.GetParameterAsText(7)                                            ## Outputs which are optional. Shown as textboxes and entered as booleans under the script properties.
-outParsedRows = arcpy.GetParameterAsText(8)
-outGeocode = arcpy.GetParameterAsText(9)
-outJoinDatasetType = arcpy.GetParameterAsText(10)                                       ## Output which is optional and entered as a string.
-arcpy.env.workspace = outGeodatabase                                                    ## Set the workspace to the output geodatabase.
+    inDatabase = arcpy.GetParameterAsText(0)                                            ## Inputs which are required.
+    selType = arcpy.GetParameterAsText(1)
+    inAddressLocator = arcpy.GetParameterAsText(2)
+    inTable = arcpy.GetParameterAsText(3)
+    inAddressColumn = arcpy.GetParameterAsText(4)
+    inZipCodeColumn = arcpy.GetParameterAsText(5)
+    outGeodatabase = arcpy.GetParameterAsText(6)                                        ## Outputs which are required.
+    outCorrections = arcpy.GetParameterAsText(7)                                        ## Outputs which are optional. Shown as textboxes and entered as booleans under the script properties.
+    outParsedRows = arcpy.GetParameterAsText(8)
+    outGeocode = arcpy.GetParameterAsText(9)
+    outJoinDatasetType = arcpy.GetParameterAsText(10)                                   ## Output which is optional and entered as a string.
+    arcpy.env.workspace = outGeodatabase                                                ## Set the workspace to the output geodatabase.
 
 def checkFileType(fileLocation, inType, inTable, inAddressColumn, inZipCodeColumn):
 ####################################################################################
 ## Check the file type specified by user input.
+## Returns the keys of the rows changed by an incremental run, or None when every row was processed.
 ####################################################################################
-filePath = "{0}\{1}".format(fileLocation, inTable)                                      ## Determine the file path.
-fields = [inAddressColumn, inZipCodeColumn]
-if selType == "Geodatabase":
-parseGeodatabase(filePath, fields)
-arcpy.env.workspace = fileLocation
-elif selType == "CSV":
-parseCSV(fileLocation)
-elif selType == "XLS":
-parseXLS(fileLocation)
-else:
-arcpy.AddMessage(selType)
-## arcpy.AddMessage("File type not supported. Input geodatabase, .csv, .xls or .xlsx file.")
+    filePath = "{0}\\{1}".format(fileLocation, inTable)                                 ## Determine the file path.
+    fields = [inAddressColumn, inZipCodeColumn]
+    if incrementalMode and inKeyColumn is not None:
+        fields.append(inKeyColumn)                                                      ## Readers yield the key after the address and zipcode.
+    if inType == "Geodatabase":
+        arcpy.env.workspace = fileLocation
+        return generateTable(parseGeodatabase(filePath, fields))
+    elif inType == "CSV":
+        return generateTable(parseCSV(fileLocation, fields))
+    elif inType == "XLS":
+        return generateTable(parseXLS(fileLocation, fields))
+    elif inType == "XLSX":
+        return generateTable(parseXLSX(fileLocation, fields))
+    else:
+        arcpy.AddMessage(inType)
+        ## arcpy.AddMessage("File type not supported. Input geodatabase, .csv, .xls or .xlsx file.")
+
+####################################################################################
+## Input readers.
+## Each reader is a generator which yields one (address, zipcode) pair at a time, so rows are handed to
+## generateTable as they are read instead of being collected into lists first. The address and zipcode
+## columns are found by name in the header row of CSV and Excel files. When a key column is requested it
+## is yielded as a third value.
+####################################################################################
+def findColumns(header, fieldsToParse):
+####################################################################################
+## Returns the position of each requested column in a header row. Names are compared without regard to
+## case or surrounding whitespace.
+####################################################################################
+    headerIndex = {}
+    for index, columnHeader in enumerate(header or []):
+        headerIndex.setdefault(cellText(columnHeader).strip().upper(), index)
+    columnIndexes = []
+    for field in fieldsToParse:
+        if field.strip().upper() not in headerIndex:
+            arcpy.AddError("Error, column {0} not found in the input file header.".format(field))
+            raise ValueError(field)
+        columnIndexes.append(headerIndex[field.strip().upper()])
+    return columnIndexes
+
+def cellText(value):
+####################################################################################
+## Converts a spreadsheet cell to a string. Empty cells become a blank string and whole numbers lose
+## their trailing .0.
+####################################################################################
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    if isinstance(value, stringTypes):
+        return value
+    return str(value)
 
 def parseGeodatabase(inputFile, fieldsToParse):
 ####################################################################################
 ## Parse a geodatabase input.
 ####################################################################################
-arcpy.AddMessage("Parsing Geodatabase.")
-addressPull = []
-zipPull = []
-rowCounter = 0
-with arcpy.da.SearchCursor(inputFile, fieldsToParse) as cursor:                         ## Pull addresses and zip codes from a feature class.
-for row in cursor:
-    addressPull.append(row[0])
-    zipPull.append(row[1])
-    generateTable(addressPull,zipPull)
+    arcpy.AddMessage("Parsing Geodatabase.")
+    with arcpy.da.SearchCursor(inputFile, fieldsToParse) as cursor:                     ## Pull addresses and zip codes from a feature class.
+        for row in cursor:
+            yield tuple(row)
 
-def parseCSV(inputFile):                                                                ## Use the reader method to read the csv file.
+def parseCSV(inputFile, fieldsToParse):                                                 ## Use the reader method to read the csv file.
 ####################################################################################
 ## Parse a csv input.
+## The file is memory mapped and read a line at a time, so it is never loaded whole.
 ####################################################################################
-arcpy.AddMessage("Parsing CSV.")
-addressPull = []
-zipPull = []
+    arcpy.AddMessage("Parsing CSV.")
+    with open(inputFile, 'rb') as infile:
+        if os.fstat(infile.fileno()).st_size == 0:                                      ## An empty file can't be memory mapped.
+            return
+        mappedFile = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            lines = iter(mappedFile.readline, b'')
+            if sys.version_info[0] >= 3:
+                lines = (line.decode(csvEncoding) for line in lines)
+            reader = csv.reader(lines, delimiter=',', quotechar='"')                    ## Based on the default values, the first row in the csv is assumed to be the header.
+            columnIndexes = findColumns(next(reader, None), fieldsToParse)
+            lastIndex = max(columnIndexes)
+            for row in reader:                                                          ## Increment through each row in the csv file.
+                if not row:                                                             ## Skip blank lines.
+                    continue
+                if len(row) <= lastIndex:
+                    row = row + [''] * (lastIndex + 1 - len(row))                       ## Short rows are treated as blank values.
+                yield tuple(row[index] for index in columnIndexes)
+        finally:
+            mappedFile.close()
 
-with open(inputFile, 'rb') as infile:
-    reader = csv.reader(open(inputFile, 'rb'), delimiter=',', quotechar='"')            ## Based on the default values, the first row in the csv is assumed to be the header.
-    next(reader, None)                                                                  ## Skip the header of the csv file.
-for row in reader:                                                                      ## Increment through each row in the csv file.
-    addressPull.append(''.join(row[1]))
-    zipPull.append(''.join(row[2]))
+def parseXLS(inputFile, fieldsToParse):
+####################################################################################
+## Parse an xls file.
+####################################################################################
+    arcpy.AddMessage("Parsing XLS.")
+    wb = xlrd.open_workbook(inputFile, on_demand=True)                                  ## Only load worksheets as they are requested.
+    try:
+        worksheet = wb.sheet_by_index(0)                                                ## Open the first worksheet in the file.
+        if worksheet.nrows == 0:
+            return
+        columnIndexes = findColumns(worksheet.row_values(0), fieldsToParse)
+        for curRow in range(1, worksheet.nrows):                                        ## Loops thorugh the worksheet by row.
+            row = worksheet.row_values(curRow)                                          ## Read the whole row at once instead of cell by cell.
+            yield tuple(cellText(row[index]) for index in columnIndexes)
+    finally:
+        wb.release_resources()
 
-generateTable(addressPull,zipPull)
+def parseXLSX(inputFile, fieldsToParse):
+####################################################################################
+## Parse an xlsx file.
+## The workbook is opened read only, so openpyxl streams the rows instead of loading the whole file.
+####################################################################################
+    arcpy.AddMessage("Parsing XLSX.")
+    if openpyxl is None:
+        arcpy.AddError("Error, XLSX input requires the openpyxl library.")
+        raise ImportError("openpyxl")
+    wb = openpyxl.load_workbook(inputFile, read_only=True, data_only=True)
+    try:
+        rows = wb.worksheets[0].iter_rows(values_only=True)                             ## Open the first worksheet in the file.
+        columnIndexes = findColumns(next(rows, None), fieldsToParse)
+        lastIndex = max(columnIndexes)
+        for row in rows:
+            if len(row) <= lastIndex:
+                row = tuple(row) + (None,) * (lastIndex + 1 - len(row))
+            yield tuple(cellText(row[index]) for index in columnIndexes)
+    finally:
+        wb.close()
 
-def parseXLS(inputFile):
+def generateTable(inputRows):
 ####################################################################################
-## Parse an xls file.
+## Streams rows from a reader through addressFormat, zipFormat and addressParse and writes each row to
+## the output tables as soon as they have been formatted. Only a few chunks of rows are held in memory.
+## In incremental mode only rows inserted or changed since the last run are processed. Their old rows
+## and the rows deleted from the input are removed from the output tables, and the keys of all of them
+## are returned. None is returned when the tables were rebuilt from every row.
 ####################################################################################
-arcpy.AddMessage("Parsing XLS.")
-addressPull = []
-zipPull = []
+    if outParsedRows == True:                                                           ## Output parsed rows if checked by user.
+        arcpy.AddMessage("Parsing addresses.")
+        outColumns = columnList + approvedParseList
+    else:
+        outColumns = columnList
 
-with xlrd.open_workbook(inputFile) as wb:
-    worksheet = wb.sheet_by_index(0)                                                    ## Open the first worksheet in the file.
-    numRows = worksheet.nrows - 1                                                       ## Determine the total number of rows in the worksheet.
-    curRow = 0                                                                          ## Set the value of the current row to 0 befor running the loop.
-while curRow < numRows:                                                                 ## Loops thorugh the worksheet by row.
-    curRow += 1                                                                         ## Increments the current row by 1.
-    addressPull.append(worksheet.cell_value(curRow,1))
-    zipPull.append(str(worksheet.cell_value(curRow,2)))
+    numberedRows = numberRows(runStats.timedRows("read", inputRows))
+    rowState = None
+    appendRows = False
+    if incrementalMode:
+        if outFormat not in ["Geodatabase","SQLite"]:
+            arcpy.AddError("Error, incremental mode needs Geodatabase or SQLite output.")
+            raise ValueError(outFormat)
+        rowState = RowState(rowStateDatabase, stateVersionHash(), outputTablesExist())
+        appendRows = rowState.isComplete                                                ## Rebuild the tables if the last run didn't finish, used other settings or a table is missing.
+        numberedRows = rowState.filterChanged(numberedRows)
 
-generateTable(addressPull,zipPull)
+    arcpy.AddMessage("Formatting Addresses.")
+    processedRows = processRows(numberedRows, outParsedRows == True)
+    deltaKeys = None
+    if appendRows:
+        processedRows = list(processedRows)                                             ## Only inserted and changed rows are held, which is a small share of the input.
+        deltaKeys = [row[0] for chunk in processedRows for row in chunk] + rowState.deletedKeys()
+        arcpy.AddMessage("Updating {0} changed rows.".format(len(deltaKeys)))
+        deleteTableRows(outTable, deltaKeys)
+        deleteTableRows(outCorrectionTable, deltaKeys)
 
-def generateTable(addressList, zipList):
     arcpy.AddMessage("Creating address table.")
-addressHolder = addressFormat(addressList)
-zipHolder = zipFormat(zipList)
-arcpy.CreateTable_management(outGeodatabase, outTable)                                  ## Create address output table.
-addFields(tablePath)                                                                    ## Add fields to address output table.
-rowCounter = 0
-
-if outParsedRows == True:                                                               ## Output parsed rows if checked by user.
-arcpy.AddMessage("Parsing addresses.")
-with arcpy.da.InsertCursor(tablePath, columnList + approvedParseList) as cursor:
-    for entry in addressHolder:
-        addressInsert = ''.join(addressHolder[rowCounter])
-        zipInsert = ''.join(zipHolder[rowCounter])
-        
-if rowCounter in errorRowList:                                                          ## Skips rows where an error has been found.
-pass
-else :
-    houseNumber, streetPrefix, street, streetSuffix, apartment = addressParse(
-        addressInsert)
-cursor.insertRow((rowCounter, addressInsert, zipInsert, houseNumber,
-    streetPrefix, street, streetSuffix, apartment))
-rowCounter += 1
-else :
-    with arcpy.da.InsertCursor(tablePath, columnList) as cursor:
-    for entry in addressHolder:
-    addressInsert = ''.join(addressHolder[rowCounter])
-zipInsert = ''.join(zipHolder[rowCounter])
-if rowCounter in errorRowList:                                                          ## Skips rows where an error has been found.
-pass
-else :
-    cursor.insertRow((rowCounter, addressInsert, zipInsert))                            ## Insert values into the table with the InsertCursor.
-rowCounter += 1
-rowCounter = 0                                                                          ## Reset the rowCounter variable.
-if outCorrections == True:                                                              ## Output correction table
-if checked by user.
-arcpy.AddMessage("Creating correction table.")
-arcpy.CreateTable_management(outGeodatabase, outCorrectionTable)                        ## Create corrections table.
-addFields(correctionTablePath)                                                          ## Add fields to corrections table.
-with arcpy.da.InsertCursor(correctionTablePath, columnList) as cursor:
-    for entry in addressHolder:
-    if rowCounter in errorRowList:
-    addressInsert = ''.join(addressHolder[rowCounter])
-zipInsert = ''.join(zipHolder[rowCounter])
-cursor.insertRow((rowCounter, addressInsert, zipInsert))
-else :
-    pass
-rowCounter += 1
-
-def addressFormat(inputAddresses):
+    if outCorrections == True:                                                          ## Output correction table if checked by user.
+        arcpy.AddMessage("Creating correction table.")
+    rowsDone = 0
+    with openTableWriter(outTable, outColumns, appendRows) as cursor, openCorrectionWriter(appendRows) as correctionCursor:
+        for chunk in processedRows:
+            rowsDone += len(chunk)
+            runStats.progress(rowsDone)
+            for rowCounter, addressInsert, zipInsert, errorReasons, parsedRow in chunk:
+                if errorReasons:                                                        ## Rows where an error has been found go to the correction table with their reason codes.
+                    correctionCursor.insertRow((rowCounter, addressInsert, zipInsert, ';'.join(errorReasons)))
+                    for reason in errorReasons:
+                        runStats.count("error " + reason)
+                elif parsedRow is not None:
+                    cursor.insertRow((rowCounter, addressInsert, zipInsert) + parsedRow)
+                else:
+                    cursor.insertRow((rowCounter, addressInsert, zipInsert))            ## Insert values into the table with the output writer.
+
+    if appendRows:
+        with openTableWriter(outDeltaTable, outColumns) as cursor:                      ## The changed rows on their own, for geocoding.
+            for chunk in processedRows:
+                for rowCounter, addressInsert, zipInsert, errorReasons, parsedRow in chunk:
+                    if not errorReasons:
+                        cursor.insertRow((rowCounter, addressInsert, zipInsert) + (parsedRow or ()))
+    if rowState is not None:
+        rowState.close()
+    return deltaKeys
+
+def openCorrectionWriter(appendRows=False):
+####################################################################################
+## Returns the writer for the correction table, or a writer which discards the rows when outCorrections
+## is off.
+####################################################################################
+    if outCorrections == True:
+        return openTableWriter(outCorrectionTable, columnList + errorColumnList, appendRows)
+    return NullWriter(outCorrectionTable, columnList + errorColumnList)
+
+def numberRows(inputRows):
+####################################################################################
+## Turns the rows from a reader into (rowCounter, address, zipcode) rows. rowCounter is the value of the
+## key column when the reader yields one, otherwise the position of the row.
+####################################################################################
+    for rowCounter, row in enumerate(inputRows):
+        if len(row) > 2:
+            yield cellText(row[2]), row[0], row[1]
+        else:
+            yield rowCounter, row[0], row[1]
+
+def processRows(numberedRows, parseRows):
+####################################################################################
+## Splits the (rowCounter, address, zipcode) rows from numberRows into chunks of chunkSize rows and formats
+## and parses each chunk with formatRows. When workerCount is not 1 the chunks are spread over a process
+## pool. Chunks are yielded in the order they were read, and only a few chunks per worker are in flight
+## at any time so memory stays bounded. In columnarMode, consecutive chunks are gathered into batches of
+## about columnarBatchSize rows before they are formatted, because the pandas column operations only pay
+## off on a few thousand rows at once. On 200k rows, 1,000 row batches took twice as long as formatting
+## row by row, and 20,000 row batches half as long. The chunks are split apart again afterwards, so the
+## row cache and the output still see chunkSize rows at a time.
+####################################################################################
+    chunks = chunkRows(numberedRows, chunkSize)
+    processCount = workerCount or multiprocessing.cpu_count()
+    pool = None
+    if processCount > 1:
+        if sys.platform == 'win32':
+            multiprocessing.set_executable(os.path.join(sys.exec_prefix, 'pythonw.exe')) ## Inside ArcMap sys.executable is ArcMap.exe, not Python.
+        workerSettings = dict((name, globals()[name]) for name in workerSettingList)
+        pool = multiprocessing.Pool(processCount, initWorker, (workerSettings,))
+    rowCache = None
+    if rowCacheDatabase is not None:
+        rowCache = RowCache(rowCacheDatabase, rulesVersionHash(), rowCacheSize)
+
+    batchChunks = 1
+    if columnarMode and pandas is not None:
+        batchChunks = max(1, columnarBatchSize // chunkSize)
+
+    def startBatch(batch):
+        batchRows = [row for cachedRows, missedChunk in batch for row in missedChunk]
+        if pool is not None:
+            return batch, pool.apply_async(formatRowsWithStats, (batchRows, parseRows))
+        return batch, formatRows(batchRows, parseRows)
+
+    def finishBatch(batch, job):
+        if pool is not None:
+            formattedRows, stages, counters = job.get()
+            runStats.merge(stages, counters)                                            ## Timings and counters from the worker process.
+        else:
+            formattedRows = job
+        formattedRows = iter(formattedRows)
+        for cachedRows, missedChunk in batch:
+            batchChunk = [next(formattedRows) for row in missedChunk]                   ## Split the batch back into its chunks.
+            if rowCache is not None:
+                rowCache.store(missedChunk, batchChunk)
+            if cachedRows is None:
+                yield batchChunk
+            else:
+                batchChunk = iter(batchChunk)
+                yield [row if row is not None else next(batchChunk) for row in cachedRows] ## Put the cache misses back in read order.
+
+    try:
+        pending = deque()
+        batch = []
+        for chunk in chunks:
+            cachedRows, missedChunk = None, chunk
+            if rowCache is not None:
+                cachedRows, missedChunk = rowCache.lookup(chunk, parseRows)             ## Only rows which aren't in the cache are formatted.
+            batch.append((cachedRows, missedChunk))
+            if len(batch) < batchChunks:
+                continue
+            pending.append(startBatch(batch))
+            batch = []
+            if len(pending) >= processCount * 2 or pool is None:
+                for formattedChunk in finishBatch(*pending.popleft()):
+                    yield formattedChunk
+        if batch:
+            pending.append(startBatch(batch))
+        while pending:
+            for formattedChunk in finishBatch(*pending.popleft()):
+                yield formattedChunk
+        if pool is not None:
+            pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+        if rowCache is not None:
+            rowCache.close()
+
+def initWorker(settings):
+####################################################################################
+## Runs once in each worker process. Applies the script controls of the parent process, which a worker
+## started with spawn (the default on Windows and macOS) would otherwise read back from the script file.
+####################################################################################
+    global addressNormalizer, parseCache
+    globals().update(settings)
+    addressNormalizer = AddressNormalizer(unitDesignatorList)                           ## Both are built from script controls when the module is imported.
+    parseCache = AddressCache(parseCacheSize)
+
+def formatRowsWithStats(chunk, parseRows):
+####################################################################################
+## Runs formatRows in a worker process and returns its rows with the worker's stage timings and counters.
+####################################################################################
+    stats = RunStats()
+    formattedRows = formatRows(chunk, parseRows, stats)
+    return formattedRows, stats.stages, stats.counters
+
+def formatRows(chunk, parseRows, stats=None):
+####################################################################################
+## Formats and optionally parses a chunk of (rowCounter, address, zipcode) rows. Runs in the worker
+## processes, so errors are returned with each row instead of being written to the correction table.
+## Returns (rowCounter, address, zipcode, errorReasons, parsedRow) rows. errorReasons is a tuple of codes
+## from errorReasonList, empty when the row is valid. parsedRow is None for error rows or
+## when parsing was not requested. Timings are recorded in stats, or runStats when it is None.
+####################################################################################
+    if stats is None:
+        stats = runStats
+    if columnarMode and pandas is not None:
+        with stats.stage("addressFormat", len(chunk)):
+            addressColumn, addressErrorColumn = addressFormatColumn([row[1] for row in chunk])
+        with stats.stage("zipFormat", len(chunk)):
+            zipColumn, zipErrorColumn = zipFormatColumn([row[2] for row in chunk])
+        formattedRows = []
+        for row, formatAddress, formatZip, addressError, zipError in zip(chunk, addressColumn, zipColumn, addressErrorColumn, zipErrorColumn):
+            if addressError or zipError:
+                errorReasons = tuple(reason for reason in (addressError, zipError) if reason)
+            else:
+                errorReasons = ()
+            formattedRows.append([row[0], formatAddress, formatZip, errorReasons, None])
+    else:
+        with stats.stage("addressFormat", len(chunk)):
+            addressResults = [addressFormat(row[1]) for row in chunk]
+        with stats.stage("zipFormat", len(chunk)):
+            zipResults = [zipFormat(row[2]) for row in chunk]
+        formattedRows = [[row[0], formatAddress, formatZip, tuple(addressErrors + zipErrors), None]
+                         for row, (formatAddress, addressErrors), (formatZip, zipErrors) in zip(chunk, addressResults, zipResults)]
+    if parseRows:
+        validRows = [row for row in formattedRows if not row[3]]
+        parseHits, parseMisses = parseCache.hits, parseCache.misses
+        with stats.stage("addressParse", len(validRows)):
+            parseChunk(validRows)
+        stats.count("parse cache hits", parseCache.hits - parseHits)
+        stats.count("parse cache misses", parseCache.misses - parseMisses)
+    return [tuple(row) for row in formattedRows]
+
+def parseChunk(validRows):
+####################################################################################
+## Fills in the parsed components of formatted rows which have no errors.
+####################################################################################
+    try:
+        parsedRows = addressParseMany([row[1] for row in validRows])                    ## Parse the whole chunk with one parser.
+    except Exception:
+        parsedRows = None                                                               ## Fall back to one address at a time to find the bad row.
+    for index, row in enumerate(validRows):
+        if parsedRows is not None:
+            row[4] = parsedRows[index]
+            continue
+        try:
+            row[4] = addressParse(row[1])
+        except Exception:
+            row[3] = ("PARSE_FAILED",)                                                  ## Addresses the parser library can't handle go to the correction table.
+
+def chunkRows(inputRows, size):
+####################################################################################
+## Groups a stream of rows into lists of at most size rows.
+####################################################################################
+    inputRows = iter(inputRows)
+    chunk = list(islice(inputRows, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(inputRows, size))
+
+class AddressNormalizer(object):
 ####################################################################################
 ## Formats input addresses to match specific address standards.
+## The unit designators and special characters are removed by one precompiled pattern, so each address
+## is scanned once no matter how many designators are in the table.
 ####################################################################################
-arcpy.AddMessage("Formatting Addresses.")
-rowCounter = 0
-for row in inputAddresses:
-    formatAddress = ''.join(inputAddresses[rowCounter])
-    formatAddress = formatAddress.upper()                                               ## Change string to uppercase.
-    formatAddress = formatAddress.strip()                                               ## Remove any whitespace on each end of the string.
-if not formatAddress:                                                                   ## Initial Error checking to remove problematic addresses to a correction table.
-    errorRowList.append(rowCounter)                                                     ## Check if string is blank.
-if formatAddress[: 3].isdigit() == False:                                               ## Check if string isn 't a digit for the first 3 characters.
-if formatAddress[: 1].isdigit() == False and formatAddress[1: 3].isdigit() == True:     ## Rough check for fire numbers.
-errorRowList.append(rowCounter)
-if formatAddress.find('#') != -1:
-    formatAddress = formatAddress[: formatAddress.find('#') - 1]                        ## Truncate string to a# sign for apartment numbers.
-if formatAddress.find('/') != -1:
-    formatAddress = formatAddress[: formatAddress.find('/')]                            ## Remove one character on both sides of a / for partial street numbers.
-if formatAddress.find('REAR') != -1:
-    formatAddress = formatAddress.replace('REAR', '')                                   ## The following is a series of checks
-for specific strings relating to apartment types.
-if formatAddress.find('UPPER') != -1:
-    formatAddress = formatAddress.replace('UPPER', '')
-if formatAddress.find('UPPR') != -1:
-    formatAddress = formatAddress.replace('UPPR', '')
-if formatAddress.find('LOWER') != -1:
-    formatAddress = formatAddress.replace('LOWER', '')
-if formatAddress.find('LOWR') != -1:
-    formatAddress = formatAddress.replace('LOWR', '')
-if formatAddress.find('BACK') != -1:
-    formatAddress = formatAddress.replace('BACK', '')
-    formatAddress = re.sub('[^A-Za-z0-9 ]+', '', formatAddress)                         ## Remove all other special characters.
-    formatAddressList.append(formatAddress)
-
-rowCounter += 1
-return formatAddressList                                                                ## Return a formatted address.
+    def __init__(self, unitDesignators):
+        tokens = sorted(set(unitDesignators), key=len, reverse=True)                    ## Longest first so UPPER wins over UPPR.
+        self.truncatePattern = re.compile('[#/]')
+        self.removePattern = re.compile('|'.join([re.escape(token) for token in tokens] + ['[^A-Za-z0-9 ]+']))
 
-def zipFormat(inputZip):
+    def normalize(self, inputAddress):
+        formatAddress = cellText(inputAddress).upper().strip()                          ## NULL fields and numbers become text, then uppercase with whitespace removed on each end.
+        errorReasons = []
+        if not formatAddress:                                                           ## Check if string is blank.
+            errorReasons.append("BLANK_ADDRESS")
+        elif not formatAddress[: 3].isdigit() and not formatAddress[: 1].isdigit() and formatAddress[1: 3].isdigit():
+            errorReasons.append("FIRE_NUMBER")                                          ## Rough check for fire numbers.
+        match = self.truncatePattern.search(formatAddress)
+        if match is not None:
+            if match.group() == '/':
+                formatAddress = formatAddress[: match.start()]                          ## Remove one character on both sides of a / for partial street numbers.
+            elif match.start() > 0:
+                formatAddress = formatAddress[: match.start() - 1]                      ## Truncate string to a# sign for apartment numbers.
+            else:
+                formatAddress = formatAddress[: -1]                                     ## A leading # keeps the old slicing behaviour.
+                if formatAddress.find('/') != -1:
+                    formatAddress = formatAddress[: formatAddress.find('/')]
+        formatAddress = self.removePattern.sub('', formatAddress)                       ## Remove unit designators and all other special characters.
+        return formatAddress, errorReasons
+
+addressNormalizer = AddressNormalizer(unitDesignatorList)
+
+def addressFormat(inputAddress):
 ####################################################################################
-## Formats input zipcodes.
+## Formats an input address to match specific address standards.
+## Returns the formatted address and a list of reason codes for any errors found in it.
 ####################################################################################
-rowCounter = 0
-for row in inputZip:
-    formatZip = ''.join(inputZip[rowCounter])
-    formatZip = formatZip.strip()
+    return addressNormalizer.normalize(inputAddress)
 
+def zipFormat(inputZip):
+####################################################################################
+## Formats an input zipcode.
+## Returns the formatted zipcode and a list of reason codes for any errors found in it.
+####################################################################################
+    formatZip = cellText(inputZip).strip()                                              ## NULL fields become blank and numbers lose their trailing .0.
+    errorReasons = []
     if not formatZip:                                                                   ## Initial Error checking to remove problematic addresses to a correction table.
-        errorRowList.append(rowCounter)
-    if formatZip[: 5].isdigit() == False:                                               ## Check if first five characters are digits.
-        errorRowList.append(rowCounter)
-        formatZip = re.sub('[^0-9]+', '', formatZip)                                    ## Remove all other special characters.
-        formatZip = formatZip[: 5]                                                      ## Return only the first five characters.
-        formatZipList.append(formatZip)                                                 ## Append the zip code to the zip code list.
+        errorReasons.append("BLANK_ZIP")
+    elif formatZip[: 5].isdigit() == False:                                             ## Check if first five characters are digits.
+        errorReasons.append("NON_NUMERIC_ZIP")
+    formatZip = re.sub('[^0-9]+', '', formatZip)                                        ## Remove all other special characters.
+    formatZip = formatZip[: 5]                                                          ## Return only the first five characters.
+    return formatZip, errorReasons
+
+####################################################################################
+## Columnar formatting.
+## The same rules as addressFormat and zipFormat, applied to a whole column of values at once with pandas
+## string operations. Each function returns the formatted column and an error column holding the reason
+## code for each row, or a blank string for valid rows. Only printable ASCII strings are handled by the
+## column rules, so pandas and pyarrow give exactly the scalar results. Anything else, including an address
+## starting with #, is passed through the scalar function.
+####################################################################################
+stringTypes = (str, type(u''))
+columnScalarPattern = '[^ -~]'                                                          ## Characters outside printable ASCII.
+
+def addressFormatColumn(inputValues):
+    column = pandas.Series(inputValues, dtype=object)
+    isScalar = ~column.map(lambda value: isinstance(value, stringTypes))
+    formatColumn = column.where(~isScalar, '').astype(columnStringType)
+    isScalar |= formatColumn.str.contains(columnScalarPattern, regex=True)
+    formatColumn = formatColumn.str.upper().str.strip()
+    isScalar |= formatColumn.str.startswith('#')                                        ## A leading # uses the old slicing behaviour.
+    isBlank = formatColumn == ''
+    isFireNumber = ~isBlank & ~formatColumn.str[: 3].str.isdigit() & ~formatColumn.str[: 1].str.isdigit() & formatColumn.str[1: 3].str.isdigit()
+    errorColumn = pandas.Series('', index=column.index, dtype=object)
+    errorColumn[isBlank] = "BLANK_ADDRESS"
+    errorColumn[isFireNumber] = "FIRE_NUMBER"
+    formatColumn = formatColumn.str.replace('(?s).#.*|/.*', '', regex=True)             ## Truncate one character before a # or at a /, whichever comes first.
+    formatColumn = formatColumn.str.replace(addressNormalizer.removePattern.pattern, '', regex=True)
+    formatList = formatColumn.tolist()
+    errorList = errorColumn.tolist()
+    for index in isScalar[isScalar].index:
+        formatAddress, errorReasons = addressFormat(inputValues[index])
+        formatList[index] = formatAddress
+        errorList[index] = errorReasons[0] if errorReasons else ''
+    return formatList, errorList
+
+def zipFormatColumn(inputValues):
+    column = pandas.Series(inputValues, dtype=object)
+    isScalar = ~column.map(lambda value: isinstance(value, stringTypes))
+    formatColumn = column.where(~isScalar, '').astype(columnStringType)
+    isScalar |= formatColumn.str.contains(columnScalarPattern, regex=True)
+    formatColumn = formatColumn.str.strip()
+    isBlank = formatColumn == ''
+    isNonNumeric = ~isBlank & ~formatColumn.str[: 5].str.isdigit()
+    errorColumn = pandas.Series('', index=column.index, dtype=object)
+    errorColumn[isBlank] = "BLANK_ZIP"
+    errorColumn[isNonNumeric] = "NON_NUMERIC_ZIP"
+    formatColumn = formatColumn.str.replace('[^0-9]+', '', regex=True).str[: 5]
+    formatList = formatColumn.tolist()
+    errorList = errorColumn.tolist()
+    for index in isScalar[isScalar].index:
+        formatZip, errorReasons = zipFormat(inputValues[index])
+        formatList[index] = formatZip
+        errorList[index] = errorReasons[0] if errorReasons else ''
+    return formatList, errorList
+
+class AddressCache(object):
+####################################################################################
+## Bounded least recently used cache. Keeps a count of hits and misses so the hit rate can be reported.
+####################################################################################
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.entries.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries[key] = value                                                       ## Move the entry to the most recently used end.
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.maxSize:
+            self.entries.popitem(last=False)                                            ## Evict the least recently used entry.
+
+    def hitRate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
+
+class RowCache(object):
+####################################################################################
+## Keeps formatted and parsed rows in a SQLite database between runs, keyed by the raw address and
+## zipcode. The database is cleared when the rules version hash changes, and once it holds more than
+## maxSize rows the rows least recently used by a run are removed.
+####################################################################################
+    def __init__(self, databasePath, version, maxSize):
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self.connection = sqlite3.connect(databasePath)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cache_info (name TEXT PRIMARY KEY, value TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS cache_rows (row_key TEXT PRIMARY KEY, row_value TEXT, last_run INTEGER)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS cache_rows_last_run ON cache_rows (last_run)")
+        info = dict(self.connection.execute("SELECT name, value FROM cache_info"))
+        if info.get("version") != version:                                              ## Cached rows were built with different rules.
+            self.connection.execute("DELETE FROM cache_rows")
+        self.runNumber = int(info.get("run", 0)) + 1
+        self.connection.executemany("INSERT OR REPLACE INTO cache_info VALUES (?, ?)", [("version", version), ("run", str(self.runNumber))])
+
+    def rowKey(self, inputAddress, inputZip):
+        return u'{0}\x1f{1}'.format(inputAddress, inputZip)
+
+    def lookup(self, chunk, parseRows):                                                 ## Returns the chunk with cached rows filled in and None for misses, and the rows which still need formatting.
+        keys = [self.rowKey(inputAddress, inputZip) for rowCounter, inputAddress, inputZip in chunk]
+        values = {}
+        for start in range(0, len(keys), 500):                                          ## Stay under the SQLite limit on query parameters.
+            batch = keys[start: start + 500]
+            query = "SELECT row_key, row_value FROM cache_rows WHERE row_key IN ({0})".format(", ".join("?" * len(batch)))
+            values.update(self.connection.execute(query, batch))
+        cachedRows = []
+        missedChunk = []
+        usedKeys = []
+        for key, row in zip(keys, chunk):
+            value = values.get(key)
+            if value is not None:
+                formatAddress, formatZip, errorReasons, parsedRow = json.loads(value)
+                if parseRows and parsedRow is None and not errorReasons:
+                    value = None                                                        ## Cached by a run which didn't parse addresses.
+            if value is None:
+                cachedRows.append(None)
+                missedChunk.append(row)
+                continue
+            if parseRows and parsedRow is not None:
+                parsedRow = tuple(parsedRow)
+            else:
+                parsedRow = None
+            cachedRows.append((row[0], formatAddress, formatZip, tuple(errorReasons), parsedRow))
+            usedKeys.append((self.runNumber, key))
+        self.connection.executemany("UPDATE cache_rows SET last_run = ? WHERE row_key = ?", usedKeys)
+        self.hits += len(usedKeys)
+        self.misses += len(missedChunk)
+        return cachedRows, missedChunk
+
+    def store(self, chunk, formattedRows):
+        entries = []
+        for (rowCounter, inputAddress, inputZip), (rowNumber, formatAddress, formatZip, errorReasons, parsedRow) in zip(chunk, formattedRows):
+            value = json.dumps([formatAddress, formatZip, errorReasons, parsedRow])
+            entries.append((self.rowKey(inputAddress, inputZip), value, self.runNumber))
+        self.connection.executemany("INSERT OR REPLACE INTO cache_rows VALUES (?, ?, ?)", entries)
+
+    def hitRate(self):
+        lookups = self.hits + self.misses
+        if lookups == 0:
+            return 0.0
+        return float(self.hits) / lookups
 
-rowCounter += 1
-return formatZipList
+    def close(self):
+        rowCount = self.connection.execute("SELECT COUNT(*) FROM cache_rows").fetchone()[0]
+        if rowCount > self.maxSize:                                                     ## Evict the least recently used rows.
+            self.connection.execute("DELETE FROM cache_rows WHERE rowid IN (SELECT rowid FROM cache_rows ORDER BY last_run LIMIT ?)", (rowCount - self.maxSize,))
+        self.connection.commit()
+        self.connection.close()
+        arcpy.AddMessage("Row cache hit rate: {0:.1%} ({1} hits, {2} misses).".format(self.hitRate(), self.hits, self.misses))
+        runStats.count("row cache hits", self.hits)
+        runStats.count("row cache misses", self.misses)
 
-def addressParse(inputAddress):                                                         ## Probably better to pass this a list instead of running the library for individual addresses.
+class RowState(object):
+####################################################################################
+## Keeps a content hash of every input row between runs in a SQLite database, keyed by UNIQUE_ROW, so an
+## incremental run can tell which rows were inserted, changed or deleted. The version is only saved once
+## a run has finished, so a run which fails part way makes the next run rebuild everything. Everything is
+## also rebuilt when tablesExist is False, because one of the output tables is missing.
+####################################################################################
+    def __init__(self, databasePath, version, tablesExist=True):
+        self.version = version
+        self.changedCount = 0
+        self.connection = sqlite3.connect(databasePath)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS state_info (name TEXT PRIMARY KEY, value TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS row_state (row_key TEXT PRIMARY KEY, row_hash TEXT, last_run INTEGER)")
+        info = dict(self.connection.execute("SELECT name, value FROM state_info"))
+        self.isComplete = info.get("version") == version and tablesExist                ## Rows only in the state database would never be written again.
+        if not self.isComplete:
+            self.connection.execute("DELETE FROM row_state")
+        self.runNumber = int(info.get("run", 0)) + 1
+        self.connection.executemany("INSERT OR REPLACE INTO state_info VALUES (?, ?)", [("version", ""), ("run", str(self.runNumber))])
+        self.connection.commit()
+
+    def filterChanged(self, numberedRows):                                              ## Yields only the rows whose hash is new or different.
+        for chunk in chunkRows(numberedRows, chunkSize):
+            keys = [u'{0}'.format(row[0]) for row in chunk]
+            hashes = {}
+            for start in range(0, len(keys), 500):                                      ## Stay under the SQLite limit on query parameters.
+                batch = keys[start: start + 500]
+                query = "SELECT row_key, row_hash FROM row_state WHERE row_key IN ({0})".format(", ".join("?" * len(batch)))
+                hashes.update(self.connection.execute(query, batch))
+            entries = []
+            changedRows = []
+            for key, row in zip(keys, chunk):
+                rowHash = hashlib.sha1(u'{0}\x1f{1}'.format(row[1], row[2]).encode('utf-8')).hexdigest()
+                entries.append((key, rowHash, self.runNumber))
+                if hashes.get(key) != rowHash:
+                    changedRows.append(row)
+            self.connection.executemany("INSERT OR REPLACE INTO row_state VALUES (?, ?, ?)", entries)
+            self.changedCount += len(changedRows)
+            for row in changedRows:
+                yield row
+
+    def deletedKeys(self):                                                              ## Removes and returns the keys of rows not seen by this run.
+        keys = [row[0] for row in self.connection.execute("SELECT row_key FROM row_state WHERE last_run < ?", (self.runNumber,))]
+        self.connection.execute("DELETE FROM row_state WHERE last_run < ?", (self.runNumber,))
+        return keys
+
+    def close(self):
+        self.connection.execute("INSERT OR REPLACE INTO state_info VALUES (?, ?)", ("version", self.version))
+        self.connection.commit()
+        self.connection.close()
+
+addressParser = None                                                                    ## One AddressParser per process, created on first use.
+parseCache = AddressCache(parseCacheSize)
+parseFieldList = ['house_number','street_prefix','street','street_suffix','apartment']  ## Attributes returned by the address parser library, in approvedParseList order.
+parseSpecialChars = re.compile('[^A-Za-z0-9 ]+')
+parseStreetSpecialChars = re.compile('[^A-Za-z0-9]+')                                   ## Street names also have their spaces removed.
+
+def rulesVersionHash():
+####################################################################################
+## Returns a hash of the formatting and parsing rules, used to tell when cached rows are stale.
+####################################################################################
+    rules = [str(rulesVersion), addressNormalizer.truncatePattern.pattern, addressNormalizer.removePattern.pattern,
+        parseSpecialChars.pattern, parseStreetSpecialChars.pattern] + parseFieldList
+    return hashlib.sha1('\n'.join(rules).encode('utf-8')).hexdigest()
+
+def stateVersionHash():
+####################################################################################
+## Returns a hash of the rules and output settings, including where the output tables are. An incremental
+## run rebuilds the output tables when it differs from the last run.
+####################################################################################
+    settings = [rulesVersionHash(), str(outParsedRows == True), str(outCorrections == True), outFormat, str(inKeyColumn),
+                os.path.abspath(str(outGeodatabase)), outSQLiteDatabase, outTable, outCorrectionTable, outGeocodeTable, outJoinDataset]
+    return hashlib.sha1('\n'.join(settings).encode('utf-8')).hexdigest()
+
+def getAddressParser():
+####################################################################################
+## Returns the AddressParser for this process. Loading the suffix and state tables is slow, so the
+## parser is only built once.
+####################################################################################
+    global addressParser
+    if addressParser is None:
+        addressParser = AddressParser()                                                 ## Initialize the address parser libary.
+    return addressParser
+
+def addressParse(inputAddress):
 ####################################################################################
 ## Parses an input string using the python address parsing library from SwoopSearch.
 ## https://github.com/SwoopSearch/pyaddress
+## Results are kept in parseCache, keyed by the formatted address.
+####################################################################################
+    parsedAddress = parseCache.get(inputAddress)
+    if parsedAddress is not None:
+        return parsedAddress
+    address = getAddressParser().parse_address(inputAddress)                            ## Pass an address to the address parser library.
+    parsedAddress = []
+    for item in parseFieldList:                                                         ## Each parsed value is formatted the same way.
+        currentItem = getattr(address, item)
+        if currentItem is None:
+            parsedAddress.append("")                                                    ## If the value is None, then change to a blank string.
+            continue
+        currentItem = str(currentItem).strip().upper()                                  ## Strip whitespace and change to uppercase.
+        if item == 'street':
+            currentItem = parseStreetSpecialChars.sub('', currentItem)
+        else:
+            currentItem = parseSpecialChars.sub('', currentItem)                        ## Remove all special characters.
+        parsedAddress.append(currentItem)
+    parsedAddress = tuple(parsedAddress)
+    parseCache.put(inputAddress, parsedAddress)
+    return parsedAddress
+
+def addressParseMany(inputAddresses):
+####################################################################################
+## Parses a batch of formatted addresses with the shared parser and cache.
+## Returns a list of (HOUSE_NBR, STREET_PRE, STREET_NAME, STREET_SUF, STREET_APT) tuples.
+####################################################################################
+    return [addressParse(inputAddress) for inputAddress in inputAddresses]
+
+####################################################################################
+## Output writers.
+## Each writer creates its table once with a fixed list of columns, buffers rows passed to insertRow and
+## writes them writeBatchSize rows at a time. Writers are used like an arcpy InsertCursor in a with block.
+## With appendRows an existing Geodatabase or SQLite table is added to instead of being replaced.
+####################################################################################
+def openTableWriter(tableName, columns, appendRows=False):
+    if outFormat == "Geodatabase":
+        return GeodatabaseWriter(tableName, columns, appendRows)
+    elif outFormat == "SQLite":
+        return SQLiteWriter(tableName, columns, appendRows)
+    elif outFormat == "CSV":
+        return CSVWriter(tableName, columns, appendRows)
+    elif outFormat == "Parquet":
+        return ParquetWriter(tableName, columns, appendRows)
+    arcpy.AddError("Error, output format not present in approved output list.")
+    raise ValueError(outFormat)
+
+def outputTablesExist():
 ####################################################################################
-ap = AddressParser()                                                                    ## Initialize the address parser libary.
-address = ap.parse_address(inputAddress) ## Pass an address to the address parser library.
-## Since each parsed value needs to be modified in the same format, there may be a way to iterate through
-## each returned value. However, the below method in comments does not work and will require further research.
-##
-## parsefieldList = ['house_number','street_prefix','address.street','street_suffix', 'apartment']
-##
-## for item in parsefieldList:
-## strHouseNumber
-## currentItem = parsefieldList.index(item)
-## currentItem = str(address.currentItem).strip().upper()
-## currentItem = re.sub('[^A-Za-z0-9 ]+', '', currentItem)
-if address.house_number is not None: ##Check if house_number returns a value.
-    strHouseNumber = str(address.house_number).strip().upper()                          ## Strip whitespace and change to uppercase.
-    strHouseNumber = re.sub('[^A-Za-z0-9 ]+', '', strHouseNumber)                       ## Remove all special characters.
-    
-else: strHouseNumber = ""                                                               ## If house_number is None, then change to a blank string.
-if address.street_prefix is not None:
-    strStreetPrefix = str(address.street_prefix).strip().upper()
-strStreetPrefix = re.sub('[^A-Za-z0-9 ]+', '', strStreetPrefix)
-else :
-    strStreetPrefix = ""
-if address.street is not None: strStreet =
-    str(address.street).strip().upper() strStreet = re.sub('[^A-Za-z0-9]+', '', strStreet)
-else :strStreet = ""
-if address.street_suffix is not None: strStreetSuffix = str(address.street_suffix).strip().upper()
-strStreetSuffix = re.sub('[^A-Za-z0-9 ]+', '', strStreetSuffix)
-else :
-    strStreetSuffix = ""
-if address.apartment is not None: strApartment =
-    str(address.apartment).strip().upper() strApartment =
-    re.sub('[^A-Za-z0-9 ]+', '', strApartment)
-else :strApartment = ""
-return (strHouseNumber, strStreetPrefix, strStreet, strStreetSuffix,
-    strApartment) 
-    
-def addFields(featureClassLocation):                                                    ## Check to see if field names don 't exist. If they don' t exist, create them.
-    
-for entry in columnList:                                                                ## Runs a for loop based on a set of column name lists.
-    columnHeader = ''.join(columnList[columnList.index(entry)]) 
-    
-    if not arcpy.ListFields(featureClassLocation, columnHeader):
-        arcpy.AddField_management(featureClassLocation, columnHeader, "TEXT","", "", "60") 
-    
-    if outParsedRows == True:                                                           ## Create a second series of columns if parsed rows are requested.
-    
-    for entry in approvedParseList:
-        columnHeader = ''.join(approvedParseList[approvedParseList.index(entry)]) 
-        
-        if not arcpy.ListFields(featureClassLocation, columnHeader):
-            arcpy.AddField_management(featureClassLocation, columnHeader, "TEXT","", "", "60")
-        
+## Checks that every output table an incremental run adds to is still there.
+####################################################################################
+    tableNames = [outTable]
+    if outCorrections == True:
+        tableNames.append(outCorrectionTable)
+    if outGeocode == True:
+        tableNames.append(outGeocodeTable)
+        if selJoinDatasetType is not None:
+            tableNames.append(outJoinDataset)
+    return all(tableExists(tableName) for tableName in tableNames)
+
+def tableExists(tableName):
+    if outFormat == "Geodatabase":
+        return arcpy.Exists(geodatabasePath(tableName))
+    elif outFormat == "SQLite":
+        databasePath = os.path.join(outGeodatabase, outSQLiteDatabase)
+        if not os.path.exists(databasePath):
+            return False
+        connection = sqlite3.connect(databasePath)
+        try:
+            return connection.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (tableName,)).fetchone() is not None
+        finally:
+            connection.close()
+    return os.path.exists(os.path.join(outGeodatabase, tableName + "." + outFormat.lower()))
+
+def deleteTableRows(tableName, rowKeys):
+####################################################################################
+## Removes the rows with the given UNIQUE_ROW values from a Geodatabase or SQLite output table.
+####################################################################################
+    if outFormat == "Geodatabase":
+        deleteGeodatabaseRows(geodatabasePath(tableName), rowKeys)
+    elif outFormat == "SQLite":
+        if not rowKeys or not tableExists(tableName):
+            return
+        connection = sqlite3.connect(os.path.join(outGeodatabase, outSQLiteDatabase))
+        try:
+            connection.execute("CREATE TEMP TABLE IF NOT EXISTS delete_keys (row_key PRIMARY KEY)")
+            connection.execute("DELETE FROM delete_keys")
+            connection.executemany("INSERT OR IGNORE INTO delete_keys VALUES (?)", [(rowKey,) for rowKey in rowKeys])
+            connection.execute("DELETE FROM {0} WHERE UNIQUE_ROW IN (SELECT row_key FROM delete_keys)".format(tableName)) ## One pass over the table for every key.
+            connection.commit()
+        finally:
+            connection.close()
+
+def deleteGeodatabaseRows(tableLocation, rowKeys):
+    if not rowKeys or not arcpy.Exists(tableLocation):
+        return
+    indexedFields = [field.name.upper() for index in arcpy.ListIndexes(tableLocation) for field in index.fields]
+    if "UNIQUE_ROW" not in indexedFields:
+        arcpy.AddIndex_management(tableLocation, ["UNIQUE_ROW"], "UNIQUE_ROW_IDX")      ## Lets each where clause find its rows without scanning the whole table.
+    for start in range(0, len(rowKeys), 500):                                           ## Keep each where clause to a reasonable length.
+        batch = [u'{0}'.format(rowKey).replace("'", "''") for rowKey in rowKeys[start: start + 500]]
+        whereClause = "UNIQUE_ROW IN ({0})".format(", ".join(u"'{0}'".format(rowKey) for rowKey in batch))
+        with arcpy.da.UpdateCursor(tableLocation, ["UNIQUE_ROW"], whereClause) as cursor:
+            for row in cursor:
+                cursor.deleteRow()
+
+def readTableRows(tableName, columns):
+####################################################################################
+## Yields the given columns of each row of an output table written by openTableWriter.
+####################################################################################
+    if outFormat == "Geodatabase":
+        with arcpy.da.SearchCursor("{0}\\{1}".format(outGeodatabase, tableName), columns) as cursor:
+            for row in cursor:
+                yield tuple(row)
+    elif outFormat == "SQLite":
+        connection = sqlite3.connect(os.path.join(outGeodatabase, outSQLiteDatabase))
+        try:
+            for row in connection.execute("SELECT {0} FROM {1}".format(", ".join(columns), tableName)):
+                yield row
+        finally:
+            connection.close()
+    elif outFormat == "CSV":
+        if sys.version_info[0] < 3:
+            infile = open(os.path.join(outGeodatabase, tableName + ".csv"), 'rb')
+        else:
+            infile = open(os.path.join(outGeodatabase, tableName + ".csv"), newline='')
+        with infile:
+            for row in csv.DictReader(infile):
+                values = []
+                for column in columns:
+                    value = row[column]
+                    if columnTypeList.get(column) == "DOUBLE":
+                        value = float(value) if value else None                         ## CSV values are read back as text.
+                    values.append(value)
+                yield tuple(values)
+    elif outFormat == "Parquet":
+        parquetFile = pyarrow.parquet.ParquetFile(os.path.join(outGeodatabase, tableName + ".parquet"))
+        for batch in parquetFile.iter_batches(batch_size=writeBatchSize, columns=columns):
+            for row in zip(*[batch.column(column).to_pylist() for column in columns]):
+                yield row
+
+class TableWriter(object):
+    def __init__(self, tableName, columns, appendRows=False):
+        self.tableName = tableName
+        self.columns = list(columns)
+        self.appendRows = appendRows
+        self.buffer = []
+
+    def __enter__(self):
+        with runStats.stage("write"):
+            self.createTable()
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        try:
+            if excType is None:
+                self.flush()
+        finally:
+            self.close()
+
+    def insertRow(self, row):
+        self.buffer.append(row)
+        if len(self.buffer) >= writeBatchSize:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            with runStats.stage("write", len(self.buffer)):
+                self.writeBatch(self.buffer)
+            self.buffer = []
+
+class NullWriter(TableWriter):
+    def createTable(self):
+        pass
+
+    def insertRow(self, row):
+        pass
+
+    def close(self):
+        pass
+
+class GeodatabaseWriter(TableWriter):
+    def createTable(self):
+        tableLocation = "{0}\\{1}".format(outGeodatabase, self.tableName)
+        if not self.appendRows or not arcpy.Exists(tableLocation):
+            arcpy.CreateTable_management(outGeodatabase, self.tableName)                ## Create the output table.
+            addFields(tableLocation, self.columns)                                      ## Add fields to the output table.
+        self.cursor = arcpy.da.InsertCursor(tableLocation, self.columns)
+
+    def writeBatch(self, rows):
+        insertRow = self.cursor.insertRow
+        for row in rows:
+            insertRow(row)                                                              ## Insert values into the table with the InsertCursor.
+
+    def close(self):
+        del self.cursor                                                                 ## Release the lock on the table.
+
+class SQLiteWriter(TableWriter):
+    def createTable(self):
+        self.connection = sqlite3.connect(os.path.join(outGeodatabase, outSQLiteDatabase))
+        sqliteTypes = {"DOUBLE": "REAL", "TEXT": "TEXT"}
+        columnTypes = ["{0} {1}".format(column, "INTEGER" if column == "UNIQUE_ROW" else sqliteTypes[columnTypeList.get(column, "TEXT")]) for column in self.columns]
+        if not self.appendRows:
+            self.connection.execute("DROP TABLE IF EXISTS {0}".format(self.tableName))
+        self.connection.execute("CREATE TABLE IF NOT EXISTS {0} ({1})".format(self.tableName, ", ".join(columnTypes)))
+        self.insertStatement = "INSERT INTO {0} VALUES ({1})".format(self.tableName, ", ".join("?" * len(self.columns)))
+
+    def writeBatch(self, rows):
+        self.connection.executemany(self.insertStatement, rows)
+        self.connection.commit()                                                        ## Commit each batch so the address and correction writers don't lock each other out.
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+class CSVWriter(TableWriter):
+    def createTable(self):
+        if sys.version_info[0] < 3:
+            self.outfile = open(os.path.join(outGeodatabase, self.tableName + ".csv"), 'wb')
+        else:
+            self.outfile = open(os.path.join(outGeodatabase, self.tableName + ".csv"), 'w', newline='')
+        self.writer = csv.writer(self.outfile)
+        self.writer.writerow(self.columns)
+
+    def writeBatch(self, rows):
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.outfile.close()
+
+class ParquetWriter(TableWriter):
+    def createTable(self):
+        if pyarrow is None:
+            arcpy.AddError("Error, Parquet output requires the pyarrow library.")
+            raise ImportError("pyarrow")
+        arrowTypes = {"DOUBLE": pyarrow.float64(), "TEXT": pyarrow.string()}
+        self.schema = pyarrow.schema([(column, pyarrow.int64() if column == "UNIQUE_ROW" else arrowTypes[columnTypeList.get(column, "TEXT")]) for column in self.columns])
+        self.writer = pyarrow.parquet.ParquetWriter(os.path.join(outGeodatabase, self.tableName + ".parquet"), self.schema)
+
+    def writeBatch(self, rows):
+        columns = [list(values) for values in zip(*rows)]
+        self.writer.write_table(pyarrow.Table.from_arrays(columns, schema=self.schema))
+
+    def close(self):
+        self.writer.close()
+
+def addFields(featureClassLocation, columns):                                           ## Check to see if field names don 't exist. If they don' t exist, create them.
+    existingFields = set(field.name for field in arcpy.ListFields(featureClassLocation)) ## List the fields once instead of once per column.
+    for columnHeader in columns:
+        if columnHeader not in existingFields:
+            arcpy.AddField_management(featureClassLocation, columnHeader, columnTypeList.get(columnHeader, "TEXT"),"", "", "60")
+
 def geocodeAddress(inputTable, inputAddressLocator,outputGeocodeLocation):
 ####################################################################################
 ## Geocodes an input address string using the input Address Locator.
 ####################################################################################
-arcpy.GeocodeAddresses_geocoding(inputTable, inputAddressLocator, "Address ADDRESS VISIBLE NONE;Zip ZIPCODE VISIBLE NONE", outputGeocodeLocation)
+    with runStats.stage("geocode"):
+        arcpy.GeocodeAddresses_geocoding(inputTable, inputAddressLocator, "Address ADDRESS VISIBLE NONE;Zip ZIP_CODE VISIBLE NONE", outputGeocodeLocation)
 
-def spatialJoin(joinFeature, outputFeatureClass):
+def mergeDelta(tableName, deltaTableName, deltaKeys):
+####################################################################################
+## Replaces the rows of a geocoded or joined table which were changed by an incremental run with the
+## rows produced from the delta table.
+####################################################################################
+    tableLocation = geodatabasePath(tableName)
+    deltaLocation = geodatabasePath(deltaTableName)
+    if not arcpy.Exists(tableLocation):
+        arcpy.Copy_management(deltaLocation, tableLocation)
+        return
+    deleteGeodatabaseRows(tableLocation, deltaKeys)
+    arcpy.Append_management(deltaLocation, tableLocation, "NO_TEST")
+
+def spatialJoin(joinDatasetType, joinFeature, outputFeatureClass):
 ####################################################################################
 ## Spatially joins a set of geocoded addresses to a specified file.
 ####################################################################################
-if joinFeature in approvedJoinList:
-    if joinFeature == "2010 Census Block":
-    targetDataset = r "C:\GIS\485\Final Project\BackgroundData.gdb\Rock_County_2010_Census_Block"
-elif joinFeature == "2010 Census Block Group":
-    targetDataset = r "C:\GIS\485\Final Project\BackgroundData.gdb\Rock_County_2010_Census_Block_Group"
-else :
-    arcpy.AddError("Error, join target not present in approved join list.")
-return
-
-joinOperation = 'JOIN_ONE_TO_ONE'
-joinType = 'KEEP ALL'
-fieldMappings = ''
-matchOption = 'INTERSECT'
-searchRadius = ''
-distanceFieldName = ''
-arcpy.SpatialJoin_analysis(targetDataset, joinFeature, outputFeatureClass, joinOperation, joinType, fieldMappings, matchOption, searchRadius, distanceFieldName)
-
-main()
\ No newline at end of file
+    if joinDatasetType in approvedJoinList:
+        if joinDatasetType == "2010 Census Block":
+            targetDataset = r"C:\GIS\485\Final Project\BackgroundData.gdb\Rock_County_2010_Census_Block"
+        elif joinDatasetType == "2010 Census Block Group":
+            targetDataset = r"C:\GIS\485\Final Project\BackgroundData.gdb\Rock_County_2010_Census_Block_Group"
+    else:
+        arcpy.AddError("Error, join target not present in approved join list.")
+        return
+
+    joinOperation = 'JOIN_ONE_TO_ONE'
+    joinType = 'KEEP_ALL'
+    fieldMappings = ''
+    matchOption = 'INTERSECT'
+    searchRadius = ''
+    distanceFieldName = ''                                                              ## The geocoded addresses are the target so each keeps its UNIQUE_ROW.
+    with runStats.stage("join"):
+        arcpy.SpatialJoin_analysis(joinFeature, targetDataset, outputFeatureClass, joinOperation, joinType, fieldMappings, matchOption, searchRadius, distanceFieldName)
+
+####################################################################################
+## Local geocoder.
+## Street centerlines or address points are loaded from geocodeReferenceFile into a StreetGeocoder, which
+## keys them by (STREET_NAME, STREET_SUF, ZIP) and finds a house number by interpolating along the
+## segment whose address range contains it. Addresses are geocoded from their addressParse components in
+## batches, and results are cached by formatted address and zipcode.
+####################################################################################
+def localGeocodeTable(deltaKeys=None):
+    arcpy.AddMessage("Geocoding addresses.")
+    geocoder = StreetGeocoder(loadStreetReference(geocodeReferenceFile))
+    if deltaKeys is None:
+        geocodeTableRows(geocoder, outTable, outGeocodeTable)
+    else:
+        geocodeTableRows(geocoder, outDeltaTable, outGeocodeDeltaTable)                 ## Incremental runs only geocode the changed rows.
+        deleteTableRows(outGeocodeTable, deltaKeys)
+        with openTableWriter(outGeocodeTable, geocodeColumnList, True) as cursor:
+            for row in readTableRows(outGeocodeDeltaTable, geocodeColumnList):
+                cursor.insertRow(row)
+    arcpy.AddMessage("Geocoded {0} of {1} addresses ({2:.1%}). Geocode cache hit rate: {3:.1%}.".format(
+        geocoder.matched, geocoder.matched + geocoder.unmatched, geocoder.matchRate(), geocoder.cache.hitRate()))
+    runStats.count("geocode matched", geocoder.matched)
+    runStats.count("geocode unmatched", geocoder.unmatched)
+    runStats.count("geocode cache hits", geocoder.cache.hits)
+    runStats.count("geocode cache misses", geocoder.cache.misses)
+
+def geocodeTableRows(geocoder, inputTable, outputTable):
+    inputColumns = columnList + approvedParseList if outParsedRows == True else columnList
+    with openTableWriter(outputTable, geocodeColumnList) as cursor:
+        for chunk in chunkRows(readTableRows(inputTable, inputColumns), chunkSize):
+            with runStats.stage("geocode", len(chunk)):
+                points = geocoder.geocodeMany(chunk)
+            for row, point in zip(chunk, points):
+                cursor.insertRow((row[0], row[1], row[2], point[0], point[1], "U" if point[0] is None else "M"))
+
+def loadStreetReference(referenceFile):
+####################################################################################
+## Reads (attributes, points) features from a GeoJSON file or shapefile of lines or points. Multipart
+## lines are joined into one list of points.
+####################################################################################
+    features = []
+    if referenceFile.lower().endswith(".shp"):
+        if shapefile is None:
+            arcpy.AddError("Error, shapefile references require the pyshp library.")
+            raise ImportError("shapefile")
+        reader = shapefile.Reader(referenceFile)
+        try:
+            for shapeRecord in reader.iterShapeRecords():
+                features.append((shapeRecord.record.as_dict(), [tuple(point[: 2]) for point in shapeRecord.shape.points]))
+        finally:
+            reader.close()
+        return features
+    with open(referenceFile) as infile:
+        for feature in json.load(infile)["features"]:
+            geometry = feature["geometry"]
+            if geometry is None:
+                continue
+            if geometry["type"] == "Point":
+                points = [geometry["coordinates"]]
+            elif geometry["type"] == "LineString":
+                points = geometry["coordinates"]
+            elif geometry["type"] == "MultiLineString":
+                points = [point for line in geometry["coordinates"] for point in line]
+            else:
+                continue
+            features.append((feature["properties"], [tuple(point[: 2]) for point in points]))
+    return features
+
+def houseNumberValue(value):
+####################################################################################
+## Returns the leading number of a house number or address range value, or None.
+####################################################################################
+    match = re.match(r'\s*(\d+)', cellText(value))
+    if match is None:
+        return None
+    return int(match.group(1))
+
+class StreetGeocoder(object):
+####################################################################################
+## In-memory street range index. Each key holds its segments sorted by the low end of their address
+## range, as (low, high, fromNumber, toNumber, points) tuples. Address points are segments with one point.
+## Every segment is also filed under a blank zipcode, used when an address's zipcode has no match.
+####################################################################################
+    def __init__(self, features):
+        self.index = {}
+        self.matched = 0
+        self.unmatched = 0
+        self.cache = AddressCache(geocodeCacheSize)
+        for attributes, points in features:
+            fromNumber = houseNumberValue(attributes.get(geocodeFieldList["FROM"]))
+            toNumber = houseNumberValue(attributes.get(geocodeFieldList.get("TO"), None))
+            if fromNumber is None or not points:
+                continue
+            if toNumber is None or len(points) == 1:
+                toNumber = fromNumber
+            streetName = parseStreetSpecialChars.sub('', cellText(attributes.get(geocodeFieldList["NAME"])).strip().upper())
+            streetSuffix = parseSpecialChars.sub('', cellText(attributes.get(geocodeFieldList["SUFFIX"])).strip().upper())
+            zipCode = re.sub('[^0-9]+', '', cellText(attributes.get(geocodeFieldList["ZIP"])))[: 5]
+            segment = (min(fromNumber, toNumber), max(fromNumber, toNumber), fromNumber, toNumber, points)
+            self.index.setdefault((streetName, streetSuffix, zipCode), []).append(segment)
+            if zipCode:
+                self.index.setdefault((streetName, streetSuffix, ''), []).append(segment)
+        self.lows = {}
+        for key, segments in self.index.items():
+            segments.sort(key=lambda segment: segment[0])
+            self.lows[key] = [segment[0] for segment in segments]
+
+    def geocodeMany(self, rows):                                                        ## Geocodes (UNIQUE_ROW, ADDRESS, ZIP_CODE, parsed...) rows. Returns an (x, y) for each row.
+        points = []
+        for row in rows:
+            cacheKey = (row[1], row[2])
+            point = self.cache.get(cacheKey)
+            if point is None:
+                parsedRow = row[3: 8] if len(row) >= 8 else addressParse(row[1])
+                point = self.geocode(parsedRow[0], parsedRow[2], parsedRow[3], row[2])
+                self.cache.put(cacheKey, point)
+            if point[0] is None:
+                self.unmatched += 1
+            else:
+                self.matched += 1
+            points.append(point)
+        return points
+
+    def geocode(self, houseNumber, streetName, streetSuffix, zipCode):
+        number = houseNumberValue(houseNumber)
+        if number is not None:
+            for key in ((streetName, streetSuffix, zipCode), (streetName, streetSuffix, '')):
+                segment = self.findSegment(key, number)
+                if segment is not None:
+                    return self.interpolate(segment, number)
+        return (None, None)
+
+    def findSegment(self, key, number):
+        segments = self.index.get(key)
+        if segments is None:
+            return None
+        position = bisect_right(self.lows[key], number)                                 ## Segments before this position start at or below the number.
+        for index in range(position - 1, -1, -1):
+            if segments[index][1] >= number:
+                return segments[index]
+        return None
+
+    def interpolate(self, segment, number):
+        low, high, fromNumber, toNumber, points = segment
+        if len(points) == 1 or fromNumber == toNumber:
+            return points[0]
+        fraction = float(number - fromNumber) / (toNumber - fromNumber)
+        lengths = [math.hypot(points[index + 1][0] - points[index][0], points[index + 1][1] - points[index][1]) for index in range(len(points) - 1)]
+        distance = fraction * sum(lengths)
+        for index, length in enumerate(lengths):
+            if distance <= length or index == len(lengths) - 1:
+                ratio = distance / length if length else 0.0
+                return (points[index][0] + (points[index + 1][0] - points[index][0]) * ratio,
+                    points[index][1] + (points[index + 1][1] - points[index][1]) * ratio)
+            distance -= length
+
+    def matchRate(self):
+        geocoded = self.matched + self.unmatched
+        if geocoded == 0:
+            return 0.0
+        return float(self.matched) / geocoded
+
+####################################################################################
+## Local spatial join.
+## Block or block group polygons are loaded once from a GeoJSON file or shapefile into a PolygonIndex, an
+## STR packed R-tree over the polygon bounding boxes, which can be saved to joinIndexFolder and reused.
+## Geocoded points are then assigned the joinIdField of the polygon containing them in batches.
+####################################################################################
+def localSpatialJoin(joinDatasetType, pointRows, deltaKeys=None):
+    if joinDatasetType not in approvedJoinList:
+        arcpy.AddError("Error, join target not present in approved join list.")
+        return
+    arcpy.AddMessage("Joining addresses to {0}.".format(joinDatasetType))
+    with runStats.stage("join index"):
+        polygonIndex = loadPolygonIndex(joinPolygonFiles[joinDatasetType])
+    if deltaKeys is not None:
+        deleteTableRows(outJoinDataset, deltaKeys)                                      ## Incremental runs replace only the changed rows.
+    with openTableWriter(outJoinDataset, joinColumnList, deltaKeys is not None) as cursor:
+        for chunk in chunkRows(pointRows, joinBatchSize):
+            with runStats.stage("join", len(chunk)):
+                geoids = polygonIndex.assign([(x, y) for rowKey, x, y in chunk])
+            for (rowKey, x, y), geoid in zip(chunk, geoids):
+                cursor.insertRow((rowKey, x, y, geoid or ''))
+
+def readGeocodedPoints(featureClassLocation):
+####################################################################################
+## Yields (UNIQUE_ROW, x, y) for each matched address in a geocoded feature class.
+####################################################################################
+    with arcpy.da.SearchCursor(featureClassLocation, ["UNIQUE_ROW", "SHAPE@XY"]) as cursor:
+        for rowKey, point in cursor:
+            if point is not None and point[0] is not None:                              ## Unmatched addresses have no geometry.
+                yield rowKey, point[0], point[1]
+
+def readTablePoints(tableName):
+####################################################################################
+## Yields (UNIQUE_ROW, x, y) for each matched address in a table written by the local geocoder.
+####################################################################################
+    for rowKey, x, y in readTableRows(tableName, ["UNIQUE_ROW", "X", "Y"]):
+        if x is not None:
+            yield rowKey, x, y
+
+def loadPolygonIndex(polygonFile):
+####################################################################################
+## Returns the PolygonIndex for a polygon file, from joinIndexFolder when a saved index is newer than the
+## polygon file.
+####################################################################################
+    if joinIndexFolder is None:
+        return PolygonIndex(loadPolygons(polygonFile, joinIdField))
+    indexFile = os.path.join(joinIndexFolder, os.path.splitext(os.path.basename(polygonFile))[0] + ".index")
+    if os.path.exists(indexFile) and os.path.getmtime(indexFile) >= os.path.getmtime(polygonFile):
+        with open(indexFile, 'rb') as infile:
+            polygonIndex = pickle.load(infile)
+        if polygonIndex.idField == joinIdField:
+            return polygonIndex
+    polygonIndex = PolygonIndex(loadPolygons(polygonFile, joinIdField))
+    polygonIndex.idField = joinIdField
+    with open(indexFile, 'wb') as outfile:
+        pickle.dump(polygonIndex, outfile, 2)
+    return polygonIndex
+
+def loadPolygons(polygonFile, idField):
+####################################################################################
+## Reads (id, parts) polygons from a GeoJSON file or shapefile. Each part is a list of rings and each ring
+## a list of (x, y) points. Points are tested against all rings of a polygon with the even-odd rule, so
+## holes and multipart polygons don't need to be told apart.
+####################################################################################
+    polygons = []
+    if polygonFile.lower().endswith(".shp"):
+        if shapefile is None:
+            arcpy.AddError("Error, shapefile polygons require the pyshp library.")
+            raise ImportError("shapefile")
+        reader = shapefile.Reader(polygonFile)
+        try:
+            for shapeRecord in reader.iterShapeRecords():
+                shape = shapeRecord.shape
+                partStarts = list(shape.parts) + [len(shape.points)]
+                parts = []
+                for index in range(len(shape.parts)):
+                    ring = [tuple(point[: 2]) for point in shape.points[partStarts[index]: partStarts[index + 1]]]
+                    if ringArea(ring) < 0 or not parts:                                 ## Shapefile outer rings run clockwise and holes counterclockwise.
+                        parts.append([ring])
+                    else:
+                        parts[-1].append(ring)
+                polygons.append((shapeRecord.record[idField], parts))
+        finally:
+            reader.close()
+        return polygons
+    with open(polygonFile) as infile:
+        features = json.load(infile)["features"]
+    for feature in features:
+        geometry = feature["geometry"]
+        if geometry is None:
+            continue
+        if geometry["type"] == "Polygon":
+            parts = [geometry["coordinates"]]
+        elif geometry["type"] == "MultiPolygon":
+            parts = geometry["coordinates"]
+        else:
+            continue
+        parts = [[[tuple(point[: 2]) for point in ring] for ring in part] for part in parts]
+        polygons.append((feature["properties"][idField], parts))
+    return polygons
+
+def ringArea(ring):
+####################################################################################
+## Returns the signed area of a ring, negative when the ring runs clockwise.
+####################################################################################
+    area = 0.0
+    previousX, previousY = ring[-1]
+    for x, y in ring:
+        area += previousX * y - x * previousY
+        previousX, previousY = x, y
+    return area / 2.0
+
+class PolygonIndex(object):
+####################################################################################
+## STR packed R-tree over polygon bounding boxes. Tree nodes are (minX, minY, maxX, maxY, children) tuples
+## where children is a list of nodes, or the position of a polygon for leaf entries. When shapely 2 is
+## installed the points are tested with shapely.STRtree instead.
+####################################################################################
+    nodeSize = 16
+
+    def __init__(self, polygons):
+        self.idField = None
+        self.ids = [polygonId for polygonId, parts in polygons]
+        self.parts = [parts for polygonId, parts in polygons]
+        self.rings = [[ring for part in parts for ring in part] for parts in self.parts]
+        entries = []
+        for position, rings in enumerate(self.rings):
+            xs = [x for ring in rings for x, y in ring]
+            ys = [y for ring in rings for x, y in ring]
+            if xs:
+                entries.append((min(xs), min(ys), max(xs), max(ys), position))
+        while len(entries) > self.nodeSize:
+            entries = self.packLevel(entries)
+        if entries:
+            self.root = self.makeNode(entries)
+        else:
+            self.root = (0.0, 0.0, -1.0, -1.0, [])                                      ## An empty box which no point falls in.
+        self.shapelyTree = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["shapelyTree"] = None                                                     ## Rebuilt after loading.
+        return state
+
+    def makeNode(self, entries):
+        return (min(entry[0] for entry in entries), min(entry[1] for entry in entries),
+            max(entry[2] for entry in entries), max(entry[3] for entry in entries), list(entries))
+
+    def packLevel(self, entries):
+        nodeCount = int(math.ceil(len(entries) / float(self.nodeSize)))
+        sliceSize = int(math.ceil(math.sqrt(nodeCount))) * self.nodeSize
+        entries = sorted(entries, key=lambda entry: entry[0] + entry[2])                ## Sort by the centre of each box.
+        nodes = []
+        for sliceStart in range(0, len(entries), sliceSize):
+            sliceEntries = sorted(entries[sliceStart: sliceStart + sliceSize], key=lambda entry: entry[1] + entry[3])
+            for nodeStart in range(0, len(sliceEntries), self.nodeSize):
+                nodes.append(self.makeNode(sliceEntries[nodeStart: nodeStart + self.nodeSize]))
+        return nodes
+
+    def assign(self, points):                                                           ## Returns the id of the polygon containing each (x, y) point, or None.
+        if shapely is not None:
+            return self.assignShapely(points)
+        return [self.find(x, y) for x, y in points]
+
+    def find(self, x, y):
+        stack = [self.root]
+        while stack:
+            minX, minY, maxX, maxY, children = stack.pop()
+            if x < minX or x > maxX or y < minY or y > maxY:
+                continue
+            if isinstance(children, list):
+                stack.extend(children)
+            elif self.contains(self.rings[children], x, y):
+                return self.ids[children]
+        return None
+
+    def contains(self, rings, x, y):
+        inside = False
+        for ring in rings:
+            previousX, previousY = ring[-1]
+            for ringX, ringY in ring:
+                if (ringY > y) != (previousY > y) and x < (previousX - ringX) * (y - ringY) / (previousY - ringY) + ringX:
+                    inside = not inside
+                previousX, previousY = ringX, ringY
+        return inside
+
+    def assignShapely(self, points):
+        if self.shapelyTree is None:
+            geometries = [shapely.MultiPolygon([shapely.Polygon(part[0], part[1:]) for part in parts]) for parts in self.parts]
+            self.shapelyTree = shapely.STRtree(geometries)
+        geoids = [None] * len(points)
+        if not points:
+            return geoids
+        pointGeometries = shapely.points([point[0] for point in points], [point[1] for point in points])
+        pointPositions, polygonPositions = self.shapelyTree.query(pointGeometries, predicate='intersects')
+        for pointPosition, polygonPosition in zip(pointPositions.tolist(), polygonPositions.tolist()):
+            if geoids[pointPosition] is None:
+                geoids[pointPosition] = self.ids[polygonPosition]
+        return geoids
+
+####################################################################################
+## Run statistics.
+## runStats records the wall time and row count of each stage, cache and error counters, and peak
+## memory. Stages are timed a chunk or batch at a time so the timing costs little next to the work.
+## Worker processes return their own timings with each chunk, so the format and parse stages add up
+## the time spent in every worker and can be longer than the run. When profileFile is set, the timed
+## stages are also run under cProfile.
+####################################################################################
+timer = getattr(time, "perf_counter", time.time)                                        ## perf_counter is not available in Python 2.
+
+class RunStats(object):
+    def __init__(self):
+        self.stages = OrderedDict()                                                     ## Stage name to [seconds, rows].
+        self.counters = OrderedDict()
+        self.profiler = None
+        self.depth = 0
+        self.started = None
+        self.startTime = timer()
+        self.lastProgress = self.startTime
+
+    def start(self):
+        self.__init__()
+        self.started = datetime.now()
+        if profileFile is not None:
+            self.profiler = cProfile.Profile()
+
+    def add(self, stage, seconds, rows=0):
+        totals = self.stages.get(stage)
+        if totals is None:
+            totals = self.stages[stage] = [0.0, 0]
+        totals[0] += seconds
+        totals[1] += rows
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, stages, counters):
+        for stage, (seconds, rows) in stages.items():
+            self.add(stage, seconds, rows)
+        for name, value in counters.items():
+            self.count(name, value)
+
+    @contextmanager
+    def stage(self, name, rows=0):
+        profiling = self.profiler is not None and self.depth == 0                       ## Nested stages are already inside the profiler.
+        self.depth += 1
+        if profiling:
+            self.profiler.enable()
+        stageStart = timer()
+        try:
+            yield
+        finally:
+            self.add(name, timer() - stageStart, rows)
+            if profiling:
+                self.profiler.disable()
+            self.depth -= 1
+
+    def timedRows(self, name, inputRows):                                               ## Times a row generator, such as a reader, chunkSize rows at a time.
+        inputRows = iter(inputRows)
+        while True:
+            with self.stage(name):
+                chunk = list(islice(inputRows, chunkSize))
+            self.add(name, 0.0, len(chunk))                                             ## The row count is only known once the chunk is read.
+            if not chunk:
+                return
+            for row in chunk:
+                yield row
+
+    def progress(self, rowsDone):
+        if not progressInterval:
+            return
+        now = timer()
+        if now - self.lastProgress >= progressInterval:
+            self.lastProgress = now
+            arcpy.AddMessage("Processed {0} rows, {1:.0f} rows/sec.".format(rowsDone, rowsDone / max(now - self.startTime, 1e-9)))
+
+    def peakMemory(self):                                                               ## Peak resident memory in megabytes, or None on Windows.
+        if resource is None:
+            return None
+        scale = 1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0                 ## ru_maxrss is in bytes on macOS and kilobytes on Linux.
+        peakSelf = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+        peakChildren = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale   ## Worker processes.
+        return {"self": round(peakSelf, 1), "workers": round(peakChildren, 1)}
+
+    def report(self):
+        wallSeconds = timer() - self.startTime
+        stages = OrderedDict()
+        for name, (seconds, rows) in self.stages.items():
+            stages[name] = {"seconds": round(seconds, 6), "rows": rows,
+                            "rowsPerSecond": round(rows / seconds, 1) if seconds > 0 and rows else None}
+        caches = OrderedDict()
+        for cache in ("parse cache", "row cache", "geocode cache"):
+            hits = self.counters.get(cache + " hits")
+            misses = self.counters.get(cache + " misses")
+            if hits is None and misses is None:
+                continue
+            hits, misses = hits or 0, misses or 0
+            caches[cache] = {"hits": hits, "misses": misses, "hitRate": round(float(hits) / (hits + misses), 4) if hits + misses else 0.0}
+        errors = OrderedDict((reason, self.counters.get("error " + reason, 0)) for reason in errorReasonList)
+        counters = OrderedDict((name, value) for name, value in self.counters.items()
+                               if not name.startswith(("error ", "parse cache ", "row cache ", "geocode cache ")))
+        return OrderedDict([("started", self.started.isoformat() if self.started else None),
+                            ("finished", datetime.now().isoformat()),
+                            ("wallSeconds", round(wallSeconds, 3)),
+                            ("stages", stages), ("caches", caches), ("errors", errors), ("counters", counters),
+                            ("peakMemoryMB", self.peakMemory()),
+                            ("settings", OrderedDict([("inputType", selType), ("outFormat", outFormat), ("chunkSize", chunkSize),
+                                                      ("workerCount", workerCount), ("columnarMode", columnarMode),
+                                                      ("incrementalMode", incrementalMode), ("rulesVersion", rulesVersion)]))])
+
+    def finish(self):                                                                   ## Reports the stage timings and writes the run report and profile when they were asked for.
+        report = self.report()
+        for name, stage in report["stages"].items():
+            if stage["rowsPerSecond"] is not None:
+                arcpy.AddMessage("{0}: {1:.2f} sec, {2} rows, {3:.0f} rows/sec.".format(name, stage["seconds"], stage["rows"], stage["rowsPerSecond"]))
+            else:
+                arcpy.AddMessage("{0}: {1:.2f} sec.".format(name, stage["seconds"]))
+        if reportFile is not None:
+            with open(reportFile, "w") as reportOutput:
+                json.dump(report, reportOutput, indent=2)
+            arcpy.AddMessage("Run report written to {0}.".format(reportFile))
+        if self.profiler is not None:
+            self.profiler.dump_stats(profileFile)                                       ## Read with pstats or snakeviz.
+            arcpy.AddMessage("Profile written to {0}.".format(profileFile))
+        return report
+
+runStats = RunStats()
+
+if __name__ == '__main__':                                                              ## Worker processes import this module, so only run the script when it is executed directly.
+    main()
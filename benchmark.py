@@ -0,0 +1,522 @@
+###################################################################################
+## Benchmark suite for address_parser.py.
+## Builds seeded corpora of dirty addresses and zipcodes, runs them through the CSV reader, addressFormat,
+## zipFormat, addressParse and the output writers, and records the per stage timings from runStats. ArcGIS
+## is not needed. A stand-in arcpy module is installed before address_parser is imported, and its
+## InsertCursor throws rows away, so Geodatabase output measures the script's side of the writes.
+## --verify checks instead that the formatting paths agree with each other and that incremental runs
+## write the same tables as full runs, see verifyRows and verifyIncremental.
+## Each benchmark runs repeatCount times and keeps the best time of every stage. Results are added to
+## resultsFile and compared with the median of the last baselineCount results of the same corpus and
+## settings. A stage which took at least regressionMinimumSeconds and whose rows/sec dropped by more than
+## regressionThreshold is run repeatCount more times, and if it is still slower it is reported and the
+## exit code is 1.
+##
+## python benchmark.py --sizes 10000 100000 --formats SQLite CSV --label my-change
+###################################################################################
+
+###################################################################################
+## Library Import
+###################################################################################
+from __future__ import print_function
+import sys,os,re,csv,json,random,platform,shutil,sqlite3,subprocess,tempfile,types,argparse
+from bisect import bisect_right
+from collections import OrderedDict
+from datetime import datetime
+
+###################################################################################
+## Script Controls
+###################################################################################
+corpusSizes = [10000, 100000]                                                           ## Rows in each corpus. The suite is meant for 10,000 up to 10,000,000 rows.
+corpusSeed = 485                                                                        ## The same seed and corpusVersion give the same corpus on the same major Python version.
+corpusVersion = 1                                                                       ## Increase when the generator changes so old results aren't compared with new corpora.
+benchmarkFormatList = ["Geodatabase","SQLite","CSV","Parquet"]                          ## Output formats timed. Parquet is skipped when pyarrow is missing.
+benchmarkFolder = None                                                                  ## Folder where corpora are kept between runs. None uses a temporary folder.
+resultsFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_results.json")
+regressionThreshold = 0.20                                                              ## Fractional drop in rows/sec reported as a regression.
+baselineCount = 5                                                                       ## Number of earlier results whose median each result is compared with.
+repeatCount = 5                                                                         ## Runs of each benchmark. The best time of each stage over the runs is kept.
+regressionMinimumSeconds = 0.1                                                          ## Stages shorter than this in either result are too noisy to compare.
+corpusHeader = ["ADDRESS","ZIPCODE"]
+streetNameList = ["MAIN","OAK","ELM","MILWAUKEE","CENTER","JACKSON","RIVER","PARK","WASHINGTON","RACINE",
+                  "COURT","MADISON","PROSPECT","HIGHLAND","CHERRY","MINERAL POINT","STATE","LINCOLN","RUGER","COUNTY ROAD A"]
+streetPrefixList = ["","","","","N","S","E","W"]
+streetSuffixList = ["ST","AVE","RD","DR","LN","CT","BLVD","WAY","PKWY","PL"]
+zipCodeList = ["53545","53546","53511","53563","53548","53534","53505","53525"]
+addressCaseList = [("plain", 52), ("repeat", 10), ("unit", 10), ("fraction", 5), ("designator", 10), ## Share of each kind of address in a corpus.
+                   ("messy", 6), ("fireNumber", 4), ("blank", 3)]
+zipCaseList = [("plain", 86), ("zipPlusFour", 7), ("number", 2), ("blank", 3), ("nonNumeric", 2)]
+
+###################################################################################
+## Stand-in arcpy.
+## Only the calls made by the CSV reader and the output writers are provided. Messages are dropped unless
+## --verbose is given, and errors are printed.
+###################################################################################
+class NullCursor(object):
+    def __init__(self, *args, **kwargs):
+        self.rows = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        return False
+
+    def __iter__(self):
+        return iter(())
+
+    def insertRow(self, row):
+        self.rows += 1
+
+class ArcpyEnv(object):
+    pass
+
+def showMessage(message):
+    if "--verbose" in sys.argv:
+        print(message)
+
+def installArcpy():
+####################################################################################
+## Puts the stand-in arcpy in sys.modules. xlrd and pyodbc are only used by readers the benchmark doesn't
+## run, so empty modules stand in for them when they aren't installed.
+####################################################################################
+    arcpy = types.ModuleType("arcpy")
+    arcpy.env = ArcpyEnv()
+    arcpy.AddMessage = showMessage
+    arcpy.AddWarning = showMessage
+    arcpy.AddError = lambda message: print(message, file=sys.stderr)
+    arcpy.GetParameterAsText = lambda index: ""
+    arcpy.Exists = lambda location: False
+    arcpy.ListFields = lambda location: []
+    arcpy.CreateTable_management = lambda *args: None
+    arcpy.AddField_management = lambda *args: None
+    arcpy.da = types.ModuleType("arcpy.da")
+    arcpy.da.InsertCursor = NullCursor
+    arcpy.da.SearchCursor = NullCursor
+    arcpy.da.UpdateCursor = NullCursor
+    sys.modules["arcpy"] = arcpy
+    sys.modules["arcpy.da"] = arcpy.da
+    for moduleName in ("xlrd", "pyodbc"):
+        try:
+            __import__(moduleName)
+        except ImportError:
+            sys.modules[moduleName] = types.ModuleType(moduleName)
+
+installArcpy()                                                                          ## At import time so worker processes started with spawn get it too.
+import address_parser
+
+###################################################################################
+## Corpus generator.
+###################################################################################
+class CorpusGenerator(object):
+####################################################################################
+## Generates (address, zipcode) rows covering the cases addressFormat and zipFormat handle: # units,
+## / fractions, unit designators, fire numbers, lower case and stray punctuation, blanks, ZIP+4 codes and
+## zipcodes read as numbers. Some addresses repeat earlier ones, as they do in real address tables.
+####################################################################################
+    def __init__(self, seed):
+        self.random = random.Random(seed)
+        self.recentRows = []
+        self.addressCases, self.addressWeights = self.cumulativeWeights(addressCaseList)
+        self.zipCases, self.zipWeights = self.cumulativeWeights(zipCaseList)
+
+    def cumulativeWeights(self, caseList):
+        names, weights, total = [], [], 0
+        for name, weight in caseList:
+            total += weight
+            names.append(name)
+            weights.append(total)
+        return names, weights
+
+    def pick(self, names, weights):
+        return names[bisect_right(weights, self.random.random() * weights[-1])]
+
+    def street(self):
+        choice = self.random.choice
+        parts = [str(self.random.randint(1, 9999)), choice(streetPrefixList), choice(streetNameList), choice(streetSuffixList)]
+        return " ".join(part for part in parts if part)
+
+    def address(self):
+        case = self.pick(self.addressCases, self.addressWeights)
+        choice = self.random.choice
+        if case == "repeat" and self.recentRows:
+            return choice(self.recentRows)[0]
+        elif case == "unit":
+            return "{0} {1}{2}".format(self.street(), choice(["#", "# ", "APT #", "UNIT #"]), self.random.randint(1, 40))
+        elif case == "fraction":
+            street = self.street().split(" ", 1)
+            return "{0} {1} {2}".format(street[0], choice(["1/2", "1/4", "3/4"]), street[1])
+        elif case == "designator":
+            return "{0}{1}{2}".format(self.street(), choice([" ", ", ", " - "]), choice(address_parser.unitDesignatorList))
+        elif case == "messy":
+            street = self.street()
+            return choice(["  {0} ", "{0}.", "{0}, ", "{0}  "]).format(choice([street.lower(), street.title(), street.replace(" ", "  ")]))
+        elif case == "fireNumber":
+            return "{0}{1} {2}".format(choice("NSEW"), self.random.randint(1000, 9999), choice(["COUNTY ROAD A", "HWY 14", "STATE RD 59", "N TOWNLINE RD"]))
+        elif case == "blank":
+            return choice(["", " ", "   "])
+        return self.street()
+
+    def zipcode(self):
+        case = self.pick(self.zipCases, self.zipWeights)
+        zipcode = self.random.choice(zipCodeList)
+        if case == "zipPlusFour":
+            return "{0}-{1:04d}".format(zipcode, self.random.randint(0, 9999))
+        elif case == "number":
+            return zipcode + ".0"                                                       ## Excel exports zipcodes stored as numbers like this.
+        elif case == "blank":
+            return ""
+        elif case == "nonNumeric":
+            return self.random.choice(["WI", "N/A", "5354", "S3545"])
+        return zipcode
+
+    def rows(self, size):
+        for rowIndex in range(size):
+            row = (self.address(), self.zipcode())
+            if len(self.recentRows) < 1000:
+                self.recentRows.append(row)
+            else:
+                self.recentRows[self.random.randrange(1000)] = row
+            yield row
+
+def corpusPath(folder, size, seed):
+####################################################################################
+## Writes the corpus as a CSV file the first time it is needed and returns its path.
+####################################################################################
+    filePath = os.path.join(folder, "corpus_v{0}_s{1}_{2}.csv".format(corpusVersion, seed, size))
+    if os.path.exists(filePath):
+        return filePath
+    partialPath = filePath + ".partial"                                                 ## An interrupted run doesn't leave a short corpus behind.
+    if sys.version_info[0] < 3:
+        outfile = open(partialPath, 'wb')
+    else:
+        outfile = open(partialPath, 'w', newline='', encoding='utf-8')
+    with outfile:
+        writer = csv.writer(outfile)
+        writer.writerow(corpusHeader)
+        writer.writerows(CorpusGenerator(seed).rows(size))
+    os.rename(partialPath, filePath)
+    return filePath
+
+###################################################################################
+## Benchmark runs.
+###################################################################################
+def runBenchmark(inputFile, rows, outFormat, workFolder):
+####################################################################################
+## Runs one corpus through address_parser with the given output format and returns the runStats report.
+####################################################################################
+    outputFolder = tempfile.mkdtemp(dir=workFolder)
+    address_parser.outGeodatabase = outputFolder
+    address_parser.outFormat = outFormat
+    address_parser.selType = "CSV"
+    address_parser.outParsedRows = True
+    address_parser.outCorrections = True
+    address_parser.outGeocode = False
+    address_parser.incrementalMode = False
+    address_parser.rowCacheDatabase = None
+    address_parser.reportFile = None
+    address_parser.profileFile = None
+    address_parser.parseCache = address_parser.AddressCache(address_parser.parseCacheSize) ## Every run starts with an empty parse cache.
+    try:
+        address_parser.runStats.start()
+        address_parser.checkFileType(inputFile, "CSV", None, corpusHeader[0], corpusHeader[1])
+        report = address_parser.runStats.report()
+    finally:
+        shutil.rmtree(outputFolder, ignore_errors=True)
+    report["rows"] = rows
+    return report
+
+def resultRecord(reports, label, commit, seed, outFormat):
+####################################################################################
+## Builds the result of repeated runs. Each stage, and the total, keeps its best time over the runs, which
+## is much steadier than any single run.
+####################################################################################
+    report = min(reports, key=lambda report: report["wallSeconds"])
+    bestStages = OrderedDict()
+    for name in report["stages"]:
+        bestStages[name] = min((run["stages"][name] for run in reports if name in run["stages"]), key=lambda stage: stage["seconds"])
+    stages = OrderedDict((name, stage["rowsPerSecond"]) for name, stage in bestStages.items())
+    return OrderedDict([("label", label), ("commit", commit), ("recorded", datetime.now().isoformat()),
+                        ("python", platform.python_version()), ("platform", platform.platform()),
+                        ("corpusVersion", corpusVersion), ("seed", seed), ("rows", report["rows"]), ("outFormat", outFormat),
+                        ("settings", report["settings"]), ("wallSeconds", report["wallSeconds"]),
+                        ("rowsPerSecond", round(report["rows"] / report["wallSeconds"], 1) if report["wallSeconds"] else None),
+                        ("stages", stages), ("stageSeconds", OrderedDict((name, stage["seconds"]) for name, stage in bestStages.items())),
+                        ("caches", report["caches"]), ("errors", report["errors"]), ("peakMemoryMB", report["peakMemoryMB"])])
+
+def resultKey(record):                                                                  ## Results are only compared when they ran the same corpus the same way.
+    return (record["corpusVersion"], record["seed"], record["rows"], record["outFormat"], json.dumps(record["settings"], sort_keys=True))
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2.0
+
+def findRegressions(previousResults, record, threshold, minimumSeconds):
+####################################################################################
+## Compares a result with the median of the last baselineCount recorded results of the same corpus and
+## settings, so one unusually fast or slow earlier run doesn't decide the outcome.
+## Returns the results compared with and a list of (measure, baseline, current) regressions. Measures
+## which took less than minimumSeconds are not compared.
+####################################################################################
+    baseline = [candidate for candidate in previousResults if resultKey(candidate) == resultKey(record)][-baselineCount:]
+    if not baseline:
+        return baseline, []
+    measures = [("total", [result["rowsPerSecond"] for result in baseline], record["rowsPerSecond"],
+                 [result["wallSeconds"] for result in baseline] + [record["wallSeconds"]])]
+    for name, rate in record["stages"].items():
+        measures.append((name, [result["stages"][name] for result in baseline if result["stages"].get(name)], rate,
+                         [result["stageSeconds"][name] for result in baseline if name in result["stageSeconds"]] + [record["stageSeconds"][name]]))
+    regressions = []
+    for name, rates, rate, seconds in measures:
+        if not rates or rate is None or min(seconds) < minimumSeconds:
+            continue
+        before = median(rates)
+        if rate < before * (1.0 - threshold):
+            regressions.append((name, before, rate))
+    return baseline, regressions
+
+def loadResults(filePath):
+    if not os.path.exists(filePath):
+        return []
+    with open(filePath) as infile:
+        return json.load(infile, object_pairs_hook=OrderedDict)
+
+def saveResults(filePath, results):
+    with open(filePath + ".partial", "w") as outfile:
+        json.dump(results, outfile, indent=2)
+    if os.path.exists(filePath):
+        os.remove(filePath)                                                             ## os.rename doesn't replace files on Windows.
+    os.rename(filePath + ".partial", filePath)
+
+def gitCommit():
+    try:
+        output = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         stderr=open(os.devnull, "w"))
+        return output.decode("ascii").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def formatRate(rate):
+    return "{0:>12,.0f}".format(rate) if rate else "{0:>12}".format("-")
+
+def printRecord(record, baseline, regressions):
+    arrow = {name: "  REGRESSION was {0:,.0f}".format(before) for name, before, after in regressions}
+    print("{0:,} rows, {1}: {2:.2f} sec, {3} rows/sec total{4}".format(
+        record["rows"], record["outFormat"], record["wallSeconds"], formatRate(record["rowsPerSecond"]).strip(), arrow.get("total", "")))
+    for name, rate in record["stages"].items():
+        print("    {0:<14} {1} rows/sec {2:>9.3f} sec{3}".format(name, formatRate(rate), record["stageSeconds"][name], arrow.get(name, "")))
+    if not baseline:
+        print("    No earlier result to compare with.")
+    else:
+        print("    Compared with the median of {0} earlier results, the latest {1} ({2}).".format(len(baseline), baseline[-1]["label"], baseline[-1]["recorded"]))
+
+###################################################################################
+## Formatting equivalence check.
+## --verify runs the seeded corpus and verifyCaseList through three checks. addressFormat must match the
+## chained find/replace rules it replaced. The pandas column functions must give exactly the scalar
+## results, when pandas is installed. The rows are also formatted in chunkSize pieces, so the scalar
+## fallback for leading # and non-ASCII values is checked inside mixed chunks too.
+###################################################################################
+verifyCaseList = [("", ""), ("   ", " "), (None, None), ("#", "#"), ("#12 MAIN ST", "53545"), ("# 4", "53545-"),
+                  ("#1/2 OAK", "53545"), ("12 OAK ST #3/4", "53545"), ("123 1/2 MAIN ST", "53545-1234"), ("/", "/"),
+                  ("12 MAIN ST REAR", " 53545 "), ("rear 12 main st", "5354"), ("12 UPPR LOWR BACK ST", "ABCDE"),
+                  ("W1234 COUNTY ROAD A", "53545.0"), ("1W23 MAIN", 53545.0), ("A", 53545), ("12", "535451234"),
+                  (123.0, "53545"), (12.5, "5354A"), (u"123 M\u00dcLLER ST", "53545"), (u"12 CAF\u00c9 ST #2", u"53\u00e945"),
+                  ("12\tMAIN\nST", "\t53545"), ("  12 n. main st.,  ", "53 545"), (u"12 STRA\u00dfE", u"\u0665\u0663\u0665\u0664\u0665")]
+
+def legacyAddressFormat(inputAddress):
+####################################################################################
+## The chained find/replace rules addressFormat used before AddressNormalizer. Returns the formatted
+## address and whether the row was flagged as an error.
+####################################################################################
+    formatAddress = ''.join(inputAddress).upper().strip()
+    flagged = not formatAddress or (not formatAddress[: 3].isdigit() and not formatAddress[: 1].isdigit() and formatAddress[1: 3].isdigit())
+    if formatAddress.find('#') != -1:
+        formatAddress = formatAddress[: formatAddress.find('#') - 1]
+    if formatAddress.find('/') != -1:
+        formatAddress = formatAddress[: formatAddress.find('/')]
+    for designator in address_parser.unitDesignatorList:
+        formatAddress = formatAddress.replace(designator, '')
+    return re.sub('[^A-Za-z0-9 ]+', '', formatAddress), flagged
+
+def verifyRows(rows, chunkSize):
+####################################################################################
+## Returns a list of (check, input, expected, actual) for every row where the formatting paths disagree.
+####################################################################################
+    mismatches = []
+    addresses = [row[0] for row in rows]
+    zipcodes = [row[1] for row in rows]
+    scalarAddresses = [address_parser.addressFormat(value) for value in addresses]
+    scalarZipcodes = [address_parser.zipFormat(value) for value in zipcodes]
+    for value, (formatAddress, errorReasons) in zip(addresses, scalarAddresses):
+        if not isinstance(value, address_parser.stringTypes):                           ## The old rules crashed on NULL and numeric values.
+            continue
+        expected = legacyAddressFormat(value)
+        if expected != (formatAddress, bool(errorReasons)):
+            mismatches.append(("addressFormat", value, expected, (formatAddress, bool(errorReasons))))
+    if address_parser.pandas is None:
+        print("pandas is not installed, the columnar check was skipped.")
+        return mismatches
+    for chunkStart in range(0, len(rows), chunkSize):
+        chunkEnd = chunkStart + chunkSize
+        checks = [("addressFormatColumn", addresses[chunkStart: chunkEnd], scalarAddresses[chunkStart: chunkEnd], address_parser.addressFormatColumn),
+                  ("zipFormatColumn", zipcodes[chunkStart: chunkEnd], scalarZipcodes[chunkStart: chunkEnd], address_parser.zipFormatColumn)]
+        for check, values, scalarResults, formatColumn in checks:
+            formatList, errorList = formatColumn(values)
+            for value, (formatValue, errorReasons), columnValue, columnError in zip(values, scalarResults, formatList, errorList):
+                expected = (formatValue, errorReasons[0] if errorReasons else '')
+                if expected != (columnValue, columnError):
+                    mismatches.append((check, value, expected, (columnValue, columnError)))
+    return mismatches
+
+###################################################################################
+## Incremental mode check.
+## --verify also runs generateTable in incrementalMode with SQLite output through changed, inserted and
+## deleted rows, a new output folder and a missing output table. After each run the output tables must
+## hold exactly what a full run over the same input writes.
+###################################################################################
+incrementalSettingList = ["outGeodatabase","outFormat","outParsedRows","outCorrections","outGeocode","incrementalMode","inKeyColumn","rowStateDatabase"]
+
+def readOutputTables(folder):
+    connection = sqlite3.connect(os.path.join(folder, address_parser.outSQLiteDatabase))
+    try:
+        return [sorted(connection.execute("SELECT * FROM {0}".format(tableName)).fetchall(), key=lambda row: str(row[0]))
+                for tableName in (address_parser.outTable, address_parser.outCorrectionTable)]
+    finally:
+        connection.close()
+
+def runIncremental(folder, rows, incremental):
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    address_parser.outGeodatabase = folder
+    address_parser.incrementalMode = incremental
+    deltaKeys = address_parser.generateTable(iter(rows))
+    return deltaKeys, readOutputTables(folder)
+
+def verifyIncremental(size, seed, workFolder):
+####################################################################################
+## Returns a list of (case, problem) for every incremental run whose output differs from a full run.
+####################################################################################
+    savedSettings = dict((name, getattr(address_parser, name)) for name in incrementalSettingList)
+    address_parser.outFormat = "SQLite"
+    address_parser.outParsedRows = True
+    address_parser.outCorrections = True
+    address_parser.outGeocode = False
+    address_parser.inKeyColumn = "KEY"
+    address_parser.rowStateDatabase = os.path.join(workFolder, "row_state.sqlite")
+    rows = [(address, zipcode, str(index)) for index, (address, zipcode) in enumerate(CorpusGenerator(seed).rows(size))]
+    randomRows = random.Random(seed)
+    changedRows = list(rows)
+    for index in randomRows.sample(range(len(changedRows)), max(size // 100, 1)):
+        changedRows[index] = ("{0} CHANGED ST".format(index), changedRows[index][1], changedRows[index][2])
+    deletedKeys = set(randomRows.sample([row[2] for row in changedRows], max(size // 200, 1)))
+    changedRows = [row for row in changedRows if row[2] not in deletedKeys] + [("1 NEW ST", "53545", "new{0}".format(index)) for index in range(5)]
+    relocatedRows = list(changedRows)
+    relocatedRows[0] = ("2 MOVED ST", "53545", relocatedRows[0][2])
+    cases = [("first run", "output", rows, False), ("changed, inserted and deleted rows", "output", changedRows, True),
+             ("new output folder", "moved", relocatedRows, False), ("missing table", "moved", rows, False)]
+    problems = []
+    try:
+        for case, folderName, caseRows, expectDelta in cases:
+            if case == "missing table":
+                connection = sqlite3.connect(os.path.join(workFolder, folderName, address_parser.outSQLiteDatabase))
+                connection.execute("DROP TABLE {0}".format(address_parser.outTable))
+                connection.commit()
+                connection.close()
+            deltaKeys, tables = runIncremental(os.path.join(workFolder, folderName), caseRows, True)
+            expectedKeys, expectedTables = runIncremental(os.path.join(workFolder, "full"), caseRows, False)
+            if (deltaKeys is not None) != expectDelta:
+                problems.append((case, "expected {0}".format("only the changed rows" if expectDelta else "a full rebuild")))
+            if tables != expectedTables:
+                problems.append((case, "output differs from a full run ({0} and {1} rows, expected {2} and {3})".format(
+                    len(tables[0]), len(tables[1]), len(expectedTables[0]), len(expectedTables[1]))))
+    finally:
+        for name, value in savedSettings.items():
+            setattr(address_parser, name, value)
+    return problems
+
+def verifyMain(arguments):
+    mismatchCount = 0
+    for size in arguments.sizes:
+        rows = list(CorpusGenerator(arguments.seed).rows(size)) + verifyCaseList
+        mismatches = verifyRows(rows, arguments.chunk_size)
+        print("{0:,} rows: {1} mismatches.".format(len(rows), len(mismatches)))
+        for check, value, expected, actual in mismatches[: 20]:
+            print("    {0} {1!r}: expected {2!r}, got {3!r}".format(check, value, expected, actual))
+        mismatchCount += len(mismatches)
+    workFolder = tempfile.mkdtemp(prefix="address_verify_")
+    try:
+        problems = verifyIncremental(min(arguments.sizes), arguments.seed, workFolder)
+    finally:
+        shutil.rmtree(workFolder, ignore_errors=True)
+    print("Incremental mode: {0} problems.".format(len(problems)))
+    for case, problem in problems:
+        print("    {0}: {1}".format(case, problem))
+    return 1 if mismatchCount or problems else 0
+
+def parseArguments():
+    parser = argparse.ArgumentParser(description="Benchmarks address_parser.py on seeded synthetic address corpora.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=corpusSizes, help="corpus sizes in rows")
+    parser.add_argument("--formats", nargs="+", default=benchmarkFormatList, choices=address_parser.approvedOutputList)
+    parser.add_argument("--seed", type=int, default=corpusSeed)
+    parser.add_argument("--repeat", type=int, default=repeatCount, help="runs of each benchmark, the best time of each stage is kept")
+    parser.add_argument("--label", default=None, help="name of this version in the results, the git commit by default")
+    parser.add_argument("--results", default=resultsFile, help="JSON file the results are added to")
+    parser.add_argument("--folder", default=benchmarkFolder, help="folder where corpora are kept between runs")
+    parser.add_argument("--threshold", type=float, default=regressionThreshold)
+    parser.add_argument("--minimum-seconds", type=float, default=regressionMinimumSeconds, help="shortest stage time compared for regressions")
+    parser.add_argument("--workers", type=int, default=address_parser.workerCount)
+    parser.add_argument("--chunk-size", type=int, default=address_parser.chunkSize)
+    parser.add_argument("--columnar", action="store_true", help="turn on columnarMode")
+    parser.add_argument("--no-save", action="store_true", help="compare without recording the results")
+    parser.add_argument("--verify", action="store_true", help="check the formatting paths give the same results instead of timing them")
+    parser.add_argument("--verbose", action="store_true", help="show the messages address_parser sends to arcpy")
+    return parser.parse_args()
+
+def main():
+####################################################################################
+## Runs every size and format and reports regressions. Returns the exit code.
+####################################################################################
+    arguments = parseArguments()
+    address_parser.workerCount = arguments.workers
+    address_parser.chunkSize = arguments.chunk_size
+    address_parser.columnarMode = arguments.columnar
+    if arguments.verify:
+        return verifyMain(arguments)
+    formats = [outFormat for outFormat in arguments.formats if outFormat != "Parquet" or address_parser.pyarrow is not None]
+    commit = gitCommit()
+    label = arguments.label or commit or "local"
+    workFolder = arguments.folder or tempfile.mkdtemp(prefix="address_benchmark_")
+    if not os.path.isdir(workFolder):
+        os.makedirs(workFolder)
+    previousResults = loadResults(arguments.results)
+    newResults = []
+    regressionCount = 0
+    try:
+        for size in arguments.sizes:
+            inputFile = corpusPath(workFolder, size, arguments.seed)
+            for outFormat in formats:
+                reports = [runBenchmark(inputFile, size, outFormat, workFolder) for run in range(max(arguments.repeat, 1))]
+                record = resultRecord(reports, label, commit, arguments.seed, outFormat)
+                baseline, regressions = findRegressions(previousResults, record, arguments.threshold, arguments.minimum_seconds)
+                if regressions:                                                         ## Run it again before reporting a slowdown, so a burst of load on the machine isn't reported.
+                    reports.extend(runBenchmark(inputFile, size, outFormat, workFolder) for run in range(max(arguments.repeat, 1)))
+                    record = resultRecord(reports, label, commit, arguments.seed, outFormat)
+                    baseline, regressions = findRegressions(previousResults, record, arguments.threshold, arguments.minimum_seconds)
+                printRecord(record, baseline, regressions)
+                regressionCount += len(regressions)
+                newResults.append(record)
+    finally:
+        if arguments.folder is None:
+            shutil.rmtree(workFolder, ignore_errors=True)
+    if not arguments.no_save and newResults:
+        saveResults(arguments.results, previousResults + newResults)
+        print("Results added to {0}.".format(arguments.results))
+    if regressionCount:
+        print("{0} measures were more than {1:.0%} slower than the earlier results.".format(regressionCount, arguments.threshold))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())